@@ -0,0 +1,471 @@
+#! /usr/bin/env python3
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+benchmark.py [--locales <N>] [--files <N>] [--units <N>] [--changed <ratio>]
+     [--repeat <N>] [--seed <N>] [--only <name>...] [--output <file.json>]
+     [--compare <file.json>] [--keep]
+
+ Time the XLIFF automation scripts on a synthetic repository, generated in a
+ temporary folder: a reference locale ('en') plus '--locales' localized
+ folders, each with '--files' XLIFF files (the main file and addons) of
+ '--units' trans-units. '--changed' is the fraction of reference strings whose
+ source text changed since the localized files were last updated.
+
+ Two kinds of benchmarks are run:
+ - Entry points, each in a new Python process on a fresh copy of the tree
+   (so they include interpreter start-up and imports, like in automation).
+ - The main functions, in process, with parsing done outside the timed code.
+
+ Results (every run, plus min and median) are printed and, with '--output',
+ saved as JSON. Pass a previous JSON file to '--compare' to print the ratio
+ against it, e.g. to compare two commits. Only lxml is required.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from copy import deepcopy
+
+import extract_source_strings
+import update_other_locales
+from functions import write_xliff
+from lxml import etree
+
+NS = {"x": "urn:oasis:names:tc:xliff:document:1.2"}
+XLIFF_NS = NS["x"]
+XML_NS = "http://www.w3.org/XML/1998/namespace"
+SCRIPTS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REFERENCE_LOCALE = "en"
+# Number of trans-units in each <file> block.
+UNITS_PER_FILE_NODE = 25
+# Fraction of strings removed upstream in the "mass removal" benchmarks, e.g.
+# after a large refactor. A quarter of the <file> blocks are removed entirely.
+MASS_REMOVAL = 0.5
+
+
+def xliff_filenames(count):
+    """Return the relative paths of the synthetic XLIFF files."""
+    filenames = ["mozillavpn.xliff"]
+    filenames += [f"addons/addon_{n:02d}/strings.xliff" for n in range(count - 1)]
+    return filenames
+
+
+def build_xliff(units, target_language, translations=None):
+    """
+    Build an XLIFF tree from 'units', a list of (original, id, source) tuples
+    grouped by 'original'. 'translations' maps an ID to its <target> text.
+    """
+    root = etree.Element(f"{{{XLIFF_NS}}}xliff", nsmap={None: XLIFF_NS})
+    root.set("version", "1.2")
+    body = None
+    current_original = None
+    for original, tu_id, source in units:
+        if original != current_original:
+            file_node = etree.SubElement(root, f"{{{XLIFF_NS}}}file")
+            file_node.set("original", original)
+            file_node.set("datatype", "plaintext")
+            file_node.set("source-language", "en")
+            file_node.set("target-language", target_language)
+            body = etree.SubElement(file_node, f"{{{XLIFF_NS}}}body")
+            current_original = original
+        trans_unit = etree.SubElement(body, f"{{{XLIFF_NS}}}trans-unit")
+        trans_unit.set("id", tu_id)
+        etree.SubElement(trans_unit, f"{{{XLIFF_NS}}}source").text = source
+        if translations and tu_id in translations:
+            target = etree.SubElement(trans_unit, f"{{{XLIFF_NS}}}target")
+            target.text = translations[tu_id]
+        note = etree.SubElement(trans_unit, f"{{{XLIFF_NS}}}note")
+        note.text = f"Comment for {tu_id}"
+    return root
+
+
+def generate_units(file_index, count):
+    units = []
+    for n in range(count):
+        original = f"src/ui/file_{file_index:02d}_{n // UNITS_PER_FILE_NODE:03d}.qml"
+        tu_id = f"file{file_index:02d}.string{n:04d}"
+        units.append((original, tu_id, f"Source text {n} of file {file_index}"))
+    return units
+
+
+def generate_tree(base_folder, options):
+    """
+    Generate the synthetic repository in base_folder. Localized files are
+    written from the original units, then the reference is updated with
+    changed source texts.
+    """
+    rng = random.Random(options.seed)
+    locales = [f"xx_{n:02d}" for n in range(options.locales)]
+    for file_index, filename in enumerate(xliff_filenames(options.files)):
+        units = generate_units(file_index, options.units)
+        for locale in locales:
+            translations = {
+                tu_id: f"{source} [{locale}]"
+                for _, tu_id, source in units
+                if rng.random() < 0.9
+            }
+            path = os.path.join(base_folder, locale, filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_xliff(
+                build_xliff(units, locale.replace("_", "-"), translations), path
+            )
+
+        changed = set(rng.sample(range(len(units)), int(len(units) * options.changed)))
+        reference_units = [
+            (original, tu_id, f"{source} (changed)" if n in changed else source)
+            for n, (original, tu_id, source) in enumerate(units)
+        ]
+        path = os.path.join(base_folder, REFERENCE_LOCALE, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_xliff(build_xliff(reference_units, "en-US"), path)
+
+    return locales
+
+
+def generate_lconvert_output(path, units):
+    """
+    Write an XLIFF file shaped like lconvert's output for a .ts file, to
+    benchmark the post-processing in extract_source_strings.py.
+    """
+    root = build_xliff(units, "en")
+    for file_node in root.xpath("//x:file", namespaces=NS):
+        file_node.set("original", "../" + file_node.get("original"))
+    for trans_unit in root.xpath("//x:trans-unit", namespaces=NS):
+        trans_unit.find("x:source", NS).set(f"{{{XML_NS}}}space", "preserve")
+        note = trans_unit.find("x:note", NS)
+        note.tag = f"{{{XLIFF_NS}}}extracomment"
+        context_group = etree.SubElement(trans_unit, f"{{{XLIFF_NS}}}context-group")
+        context = etree.SubElement(context_group, f"{{{XLIFF_NS}}}context")
+        context.set("context-type", "sourcefile")
+        context.text = "file.qml"
+    # lconvert output isn't sorted.
+    root[:] = reversed(root)
+    write_xliff(root, path)
+
+
+def remove_strings(reference_tree, ratio, seed):
+    """
+    Return a copy of reference_tree without a quarter of its <file> blocks,
+    and without 'ratio' of the remaining trans-units.
+    """
+    rng = random.Random(seed)
+    tree = deepcopy(reference_tree)
+    for n, file_node in enumerate(tree.xpath("//x:file", namespaces=NS)):
+        if n % 4 == 1:
+            file_node.getparent().remove(file_node)
+    trans_units = tree.xpath("//x:trans-unit", namespaces=NS)
+    for trans_unit in rng.sample(trans_units, int(len(trans_units) * ratio)):
+        trans_unit.getparent().remove(trans_unit)
+    return tree
+
+
+def time_runs(function, repeat, setup=None):
+    """
+    Call function() 'repeat' times and return the list of durations. If
+    provided, setup() runs before each call (not timed) and its result is
+    passed to function().
+    """
+    durations = []
+    for _ in range(repeat):
+        argument = setup() if setup else None
+        start = time.perf_counter()
+        function(argument) if setup else function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def run_script(script, *args):
+    subprocess.run(
+        [sys.executable, os.path.join(SCRIPTS_FOLDER, script), *args],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def entry_point_benchmarks():
+    """Return {name: function(work_folder)} for the entry points."""
+
+    def update(update_type):
+        return lambda folder: run_script(
+            "update_other_locales.py",
+            "--reference",
+            REFERENCE_LOCALE,
+            "--path",
+            folder,
+            "--type",
+            update_type,
+        )
+
+    benchmarks = {
+        f"update_other_locales.py --type {update_type}": update(update_type)
+        for update_type in update_other_locales.UPDATE_TYPES
+    }
+    benchmarks["check_target_language.py"] = lambda folder: run_script(
+        "check_target_language.py", "--path", folder, "--reference", REFERENCE_LOCALE
+    )
+
+    benchmarks["remove_obsolete_files.py"] = lambda folder: run_script(
+        "remove_obsolete_files.py", "--reference", REFERENCE_LOCALE, "--path", folder
+    )
+    return benchmarks
+
+
+def prepare_work_copy(pristine, work):
+    if os.path.isdir(work):
+        shutil.rmtree(work)
+    shutil.copytree(pristine, work)
+    # Leave an obsolete addon in every locale for remove_obsolete_files.py.
+    for locale in os.listdir(work):
+        if locale == REFERENCE_LOCALE:
+            continue
+        obsolete = os.path.join(work, locale, "addons", "obsolete", "strings.xliff")
+        os.makedirs(os.path.dirname(obsolete), exist_ok=True)
+        shutil.copy(os.path.join(work, locale, "mozillavpn.xliff"), obsolete)
+    return work
+
+
+def function_benchmarks(pristine, locales, scratch, options):
+    """Return {name: (function, setup)} for the in-process benchmarks."""
+    filename = "mozillavpn.xliff"
+    reference_path = os.path.join(pristine, REFERENCE_LOCALE, filename)
+    reference_tree = etree.parse(reference_path)
+    reference_index = update_other_locales.build_reference_index(
+        reference_tree.getroot(), filename
+    )
+    reduced_tree = remove_strings(reference_tree, MASS_REMOVAL, options.seed)
+    locale_paths = [os.path.join(pristine, locale, filename) for locale in locales]
+
+    def parse_locales():
+        return [etree.parse(path) for path in locale_paths]
+
+    def update_in_place(trees):
+        for tree in trees:
+            update_other_locales.update_in_place(reference_index, tree.getroot())
+
+    def rebuild(update_type, reference):
+        def run(trees):
+            for locale, tree in zip(locales, trees):
+                update_other_locales.rebuild_from_reference(
+                    reference, tree.getroot(), update_type, locale
+                )
+
+        return run
+
+    def carry_over(reference):
+        reference_ids = {
+            tu.get("id") for tu in reference.xpath("//x:trans-unit", namespaces=NS)
+        }
+
+        def setup():
+            return [
+                (deepcopy(reference).getroot(), tree.getroot())
+                for tree in parse_locales()
+            ]
+
+        def run(pairs):
+            for (new_root, locale_root), locale in zip(pairs, locales):
+                update_other_locales.carry_over_obsolete(
+                    new_root, locale_root, reference_ids, locale
+                )
+
+        return run, setup
+
+    def write_new(trees):
+        for n, tree in enumerate(trees):
+            write_xliff(tree, os.path.join(scratch, f"new_{n}.xliff"))
+
+    def copy_locales():
+        paths = []
+        for n, path in enumerate(locale_paths):
+            copy = os.path.join(scratch, f"unchanged_{n}.xliff")
+            shutil.copy(path, copy)
+            paths.append(copy)
+        return paths
+
+    def write_unchanged(paths):
+        for path in paths:
+            write_xliff(etree.parse(path), path)
+
+    lconvert_path = os.path.join(scratch, "lconvert.xliff")
+    generate_lconvert_output(lconvert_path, generate_units(0, options.units))
+
+    def extract_postprocess(_):
+        root = etree.parse(lconvert_path).getroot()
+        extract_source_strings.normalize_xliff(root)
+        write_xliff(root, os.path.join(scratch, "extracted.xliff"))
+
+    return {
+        "build_reference_index": (
+            lambda: update_other_locales.build_reference_index(
+                reference_tree.getroot(), filename
+            ),
+            None,
+        ),
+        "update_in_place": (update_in_place, parse_locales),
+        "rebuild_from_reference nofile": (
+            rebuild("nofile", reference_tree),
+            parse_locales,
+        ),
+        "rebuild_from_reference matchid": (
+            rebuild("matchid", reference_tree),
+            parse_locales,
+        ),
+        "rebuild_from_reference matchid (mass removal)": (
+            rebuild("matchid", reduced_tree),
+            parse_locales,
+        ),
+        "carry_over_obsolete": carry_over(reference_tree),
+        "carry_over_obsolete (mass removal)": carry_over(reduced_tree),
+        "write_xliff (new files)": (write_new, parse_locales),
+        "write_xliff (unchanged)": (write_unchanged, copy_locales),
+        "extract_source_strings.normalize_xliff": (
+            extract_postprocess,
+            lambda: None,
+        ),
+    }
+
+
+def summarize(durations):
+    return {
+        "runs": durations,
+        "min": min(durations),
+        "median": statistics.median(durations),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=SCRIPTS_FOLDER,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--locales", type=int, default=50, help="Number of localized folders"
+    )
+    parser.add_argument(
+        "--files", type=int, default=24, help="Number of XLIFF files per locale"
+    )
+    parser.add_argument(
+        "--units", type=int, default=50, help="Number of trans-units per file"
+    )
+    parser.add_argument(
+        "--changed",
+        type=float,
+        default=0.05,
+        help="Fraction of reference strings with a changed source text",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of runs per benchmark"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed for the synthetic content"
+    )
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        default=None,
+        help="Only run benchmarks whose name contains one of these strings",
+    )
+    parser.add_argument(
+        "--output", required=False, help="Save the results to this JSON file"
+    )
+    parser.add_argument(
+        "--compare",
+        required=False,
+        help="Previous JSON results to compare against",
+    )
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep the temporary folder with the synthetic repository",
+    )
+    options = parser.parse_args()
+
+    temp_folder = tempfile.mkdtemp(prefix="xliff_benchmark_")
+    pristine = os.path.join(temp_folder, "pristine")
+    work = os.path.join(temp_folder, "work")
+    scratch = os.path.join(temp_folder, "scratch")
+    os.makedirs(scratch)
+
+    print(f"Generating synthetic repository in {temp_folder}")
+    locales = generate_tree(pristine, options)
+
+    def selected(name):
+        return options.only is None or any(s in name for s in options.only)
+
+    results = {}
+    for name, function in entry_point_benchmarks().items():
+        if selected(name):
+            print(f"Running {name}")
+            results[name] = summarize(
+                time_runs(
+                    function,
+                    options.repeat,
+                    setup=lambda: prepare_work_copy(pristine, work),
+                )
+            )
+    for name, (function, setup) in function_benchmarks(
+        pristine, locales, scratch, options
+    ).items():
+        if selected(name):
+            print(f"Running {name}")
+            results[name] = summarize(time_runs(function, options.repeat, setup))
+
+    if not options.keep:
+        shutil.rmtree(temp_folder)
+
+    report = {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "lxml": ".".join(str(n) for n in etree.LXML_VERSION),
+        "config": {
+            "locales": options.locales,
+            "files": options.files,
+            "units": options.units,
+            "changed": options.changed,
+            "repeat": options.repeat,
+            "seed": options.seed,
+        },
+        "results": results,
+    }
+
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as fp:
+            baseline = json.load(fp)["results"]
+
+    print()
+    for name, result in results.items():
+        line = f"{name:50} min {result['min']:8.3f}s  median {result['median']:8.3f}s"
+        if name in baseline:
+            line += f"  ({result['median'] / baseline[name]['median']:.2f}x)"
+        print(line)
+
+    if options.output:
+        with open(options.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+            fp.write("\n")
+        print(f"Results saved to {options.output}")
+
+
+if __name__ == "__main__":
+    main()
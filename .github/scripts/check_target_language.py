@@ -6,12 +6,26 @@
 
 """
 check_target_language.py --path <folder>
-     [--reference <locale>] [--project <name>]
+     [--reference <locale>] [--project <name>] [--jobs <N>] [--fail-fast]
+     [--cache] [--since <git-rev>] [--profile <report.json>]
+     [--cprofile <file>] [files...]
 
  --project selects the locale mapping and excluded folders from
  locale_config.py. When no project name is provided, empty defaults are used
  (no remapping, no excluded folders).
 
+ --jobs spreads the files across N worker processes (0 means one per CPU),
+ with the same report as a serial run. --fail-fast stops at the first file
+ with errors, which is enough to fail a PR check. --cache reads the <file>
+ nodes of files unchanged since the previous run from the parse cache (see
+ xliff_cache.py). --profile and --cprofile save statistics of the run (see
+ instrumentation.py).
+
+ By default all locale folders are checked. Listing files, or passing --since
+ to check the XLIFF files changed since a git revision (e.g. the base branch of
+ a PR), restricts the check to those files. Their locale is the top-level
+ folder they are in; files outside locale folders are ignored.
+
  Verify that every localized XLIFF file declares the expected
  'target-language' on each <file> node. Pontoon owns this attribute, so this
  is a safety net that fails when a sync leaves a locale with the wrong (or
@@ -20,25 +34,164 @@ check_target_language.py --path <folder>
  The expected code matches the folder name, except for a few locales whose
  language code differs from their Pontoon folder (see the project 'mapping' in
  locale_config.py, selected with --project). The reference locale is skipped.
+ 'set_target_language_en.py --path <folder> [--project <name>] [locales...]'
+ fixes the reported locales.
 """
 
 import argparse
 import os
+import subprocess
 import sys
-from glob import glob
+from concurrent.futures import ProcessPoolExecutor
 
-from functions import list_locales
+from functions import Inventory
+from instrumentation import (
+    add_profile_arguments,
+    enable_profiling,
+    profiler,
+    start_profiling,
+)
 from locale_config import PROJECTS, get_locale_code, get_project_config
 from lxml import etree
+from xliff_cache import CACHE_FOLDER, ParseCache, default_cache_path
 
 NS = {"x": "urn:oasis:names:tc:xliff:document:1.2"}
 
 
+def file_languages(xliff_path, cache=None):
+    """
+    Return the (original, target-language) of each <file> node, reading the
+    file through 'cache' (a ParseCache) if provided.
+    """
+    if cache is not None:
+        with profiler.stage("parse"):
+            table = cache.load(xliff_path)
+        return [
+            (original, attrs.get("target-language")) for original, attrs, _ in table
+        ]
+    with profiler.stage("parse"):
+        root = etree.parse(xliff_path).getroot()
+        profiler.read(xliff_path)
+    return tree_languages(root)
+
+
+def tree_languages(root):
+    """Return the (original, target-language) of each <file> node of a tree."""
+    return [
+        (file_node.get("original"), file_node.get("target-language"))
+        for file_node in root.xpath("//x:file", namespaces=NS)
+    ]
+
+
+def check_file(xliff_path, expected, base_folder, cache=None):
+    """
+    Check a single localized XLIFF file and return (parse_errors,
+    target_errors), as described in check_target_languages().
+    """
+    try:
+        languages = file_languages(xliff_path, cache)
+    except Exception as e:
+        return [f"{xliff_path}: can't parse ({e})"], []
+    return [], language_errors(xliff_path, languages, expected, base_folder)
+
+
+def language_errors(xliff_path, languages, expected, base_folder):
+    """
+    Return the target errors of the (original, target-language) 'languages'
+    of a file.
+    """
+    target_errors = []
+    for original, actual in languages:
+        if actual != expected:
+            target_errors.append(
+                f"{os.path.relpath(xliff_path, base_folder)} ({original}): "
+                f"target-language is '{actual}', expected '{expected}'"
+            )
+    return target_errors
+
+
+def locale_files(base_folder, files, reference_locale, mapping, excluded_folders):
+    """
+    Return (locales, tasks) for check_file(), keeping only the existing XLIFF
+    files in 'files' that belong to a locale folder of 'base_folder'.
+    """
+    selected = {}
+    for path in files:
+        xliff_path = os.path.realpath(path)
+        parts = os.path.relpath(xliff_path, base_folder).split(os.sep)
+        locale = parts[0]
+        if (
+            len(parts) < 2
+            or locale.startswith(".")
+            or locale in excluded_folders
+            or locale == reference_locale
+            or not xliff_path.endswith(".xliff")
+            or not os.path.isfile(xliff_path)
+        ):
+            continue
+        selected[xliff_path] = locale
+
+    tasks = [
+        (xliff_path, get_locale_code(mapping, locale), base_folder)
+        for xliff_path, locale in sorted(selected.items(), key=lambda i: (i[1], i[0]))
+    ]
+    return sorted(set(selected.values())), tasks
+
+
+def changed_files(base_folder, since):
+    """
+    Return the files in 'base_folder' changed since the merge base of the git
+    revision 'since' and HEAD (including uncommitted changes), excluding
+    deleted files.
+    """
+    try:
+        output = subprocess.run(
+            [
+                "git",
+                "diff",
+                "--name-only",
+                "--diff-filter=d",
+                "--relative",
+                "--merge-base",
+                since,
+            ],
+            cwd=base_folder,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        sys.exit(f"ERROR: Can't list files changed since {since}\n{e}")
+    return [os.path.join(base_folder, path) for path in output.splitlines()]
+
+
+# Per-process state for --jobs workers, set once by _init_worker().
+_worker_state = {}
+
+
+def _init_worker(cache_path, profile):
+    if profile:
+        enable_profiling()
+    _worker_state["cache"] = ParseCache(cache_path) if cache_path else None
+
+
+def _check_task(task):
+    # Send the profiler statistics (None if not profiling) with the result.
+    return check_file(*task, cache=_worker_state["cache"]), profiler.take()
+
+
 def check_target_languages(
-    base_folder, reference_locale="en", mapping={}, excluded_folders=()
+    base_folder,
+    reference_locale="en",
+    mapping={},
+    excluded_folders=(),
+    jobs=1,
+    fail_fast=False,
+    files=None,
+    cache_path=None,
 ):
     """
-    Check every localized XLIFF file and return
+    Check every localized XLIFF file (or only 'files', if provided) and return
     (locales, parse_errors, target_errors):
     - 'parse_errors': files that couldn't be parsed.
     - 'target_errors': <file> nodes that don't declare the expected
@@ -47,36 +200,76 @@ def check_target_languages(
 
     'mapping' is a Pontoon-folder -> XLIFF-code dict; 'excluded_folders' lists
     non-locale folders to skip (see locale_config.get_project_config).
+
+    Files are checked by 'jobs' worker processes (0 means one per CPU), and
+    errors are reported in the same order as a serial run. With 'fail_fast',
+    the check stops after the first file with errors. With 'cache_path', the
+    <file> nodes of unchanged files are read from a ParseCache.
     """
     base_folder = os.path.realpath(base_folder)
-    locales = list_locales(
-        base_folder, excluded=excluded_folders, skip={reference_locale}
-    )
+    if files is None:
+        inventory = Inventory(base_folder, excluded=excluded_folders)
+        locales = inventory.locales(skip={reference_locale})
+        tasks = []
+        for locale in locales:
+            expected = get_locale_code(mapping, locale)
+            for filename in inventory.locale_files(locale):
+                tasks.append((inventory.path(locale, filename), expected, base_folder))
+    else:
+        locales, tasks = locale_files(
+            base_folder, files, reference_locale, mapping, excluded_folders
+        )
 
     parse_errors = []
     target_errors = []
-    for locale in locales:
-        expected = get_locale_code(mapping, locale)
-        locale_path = os.path.join(base_folder, locale)
-        for xliff_path in glob(locale_path + "/**/*.xliff", recursive=True):
-            try:
-                root = etree.parse(xliff_path).getroot()
-            except Exception as e:
-                parse_errors.append(f"{xliff_path}: can't parse ({e})")
-                continue
-
-            for file_node in root.xpath("//x:file", namespaces=NS):
-                actual = file_node.get("target-language")
-                if actual != expected:
-                    original = file_node.get("original")
-                    target_errors.append(
-                        f"{os.path.relpath(xliff_path, base_folder)} ({original}): "
-                        f"target-language is '{actual}', expected '{expected}'"
-                    )
+    cache = ParseCache(cache_path) if cache_path else None
+    jobs = jobs if jobs > 0 else os.cpu_count()
+    if jobs == 1 or len(tasks) < 2:
+        results = ((check_file(*task, cache=cache), None) for task in tasks)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_worker,
+            initargs=(cache_path, profiler.enabled),
+        )
+        # map() yields results in task order, keeping the report deterministic.
+        results = executor.map(_check_task, tasks, chunksize=32)
+    try:
+        for (file_parse_errors, file_target_errors), stats in results:
+            profiler.merge(stats)
+            parse_errors += file_parse_errors
+            target_errors += file_target_errors
+            if fail_fast and (parse_errors or target_errors):
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if cache is not None:
+            cache.close()
 
     return locales, parse_errors, target_errors
 
 
+def print_report(locales, parse_errors, target_errors):
+    """Print the result of check_target_languages(), and return True if OK."""
+    if parse_errors:
+        print("Files that could not be parsed:")
+        for error in parse_errors:
+            print(f"  {error}")
+
+    if target_errors:
+        print("Incorrect target-language found:")
+        for error in target_errors:
+            print(f"  {error}")
+
+    if parse_errors or target_errors:
+        return False
+
+    print(f"target-language is correct in {len(locales)} locales.")
+    return True
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -100,7 +293,44 @@ def main():
         help="Project config to use (locale mapping + excluded folders). "
         "Defaults to no mapping and no excluded folders.",
     )
+    parser.add_argument(
+        "--jobs",
+        required=False,
+        default=1,
+        type=int,
+        help="Number of worker processes (default: 1, serial; 0: one per CPU)",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="Stop at the first file with errors",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help=f"Cache the content of unchanged files across runs (in {CACHE_FOLDER})",
+    )
+    parser.add_argument(
+        "--since",
+        required=False,
+        default=None,
+        help="Only check XLIFF files changed since this git revision",
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="XLIFF files to check; if none are listed (and --since isn't "
+        "used), all locale files in the path will be checked",
+    )
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    start_profiling(args, "check_target_language")
+
+    files = None
+    if args.files or args.since:
+        files = list(args.files)
+        if args.since:
+            files += changed_files(os.path.realpath(args.base_folder), args.since)
 
     config = get_project_config(args.project)
     locales, parse_errors, target_errors = check_target_languages(
@@ -108,23 +338,19 @@ def main():
         args.reference_locale,
         mapping=config["mapping"],
         excluded_folders=config["excluded_folders"],
+        jobs=args.jobs,
+        fail_fast=args.fail_fast,
+        files=files,
+        cache_path=(
+            default_cache_path(os.path.realpath(args.base_folder))
+            if args.cache
+            else None
+        ),
     )
 
-    if parse_errors:
-        print("Files that could not be parsed:")
-        for error in parse_errors:
-            print(f"  {error}")
-
-    if target_errors:
-        print("Incorrect target-language found:")
-        for error in target_errors:
-            print(f"  {error}")
-
-    if parse_errors or target_errors:
+    if not print_report(locales, parse_errors, target_errors):
         sys.exit(1)
 
-    print(f"target-language is correct in {len(locales)} locales.")
-
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,326 @@
+#! /usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+check_translations.py --path <folder> [--reference <locale>] [--project <name>]
+     [--length-threshold <N>] [--stats]
+
+ Lint the translations of all locales against their source text:
+ - placeholders: a translation must use the same Qt placeholders (%1, %L1,
+   %n...) as its source, as many times, in any order. In plural forms
+   (lconvert's 'x-gettext-plurals' groups), %n and %Ln can be left out.
+   Sources without placeholders aren't checked, since '%' is then literal.
+ - markup: a translation must use the same tags as its source (e.g. <i>,
+   <a href="...">, </a>), properly nested.
+ - length: translations much longer or shorter than their source, compared
+   with the usual ratio of the locale, are reported as warnings.
+
+ Locales are the folders checked by check_target_language.py: all of them
+ except the reference, and the folders excluded by --project. Placeholder and
+ markup errors, and files that can't be parsed, make the check fail.
+
+ All the translations are extracted in a single pass over the files into a
+ columnar table (one list per field, one row per translated string), and each
+ check runs over whole columns. Sources are analyzed once per distinct text,
+ since the same string is translated in every locale.
+
+ The length ratio of a row is log(len(translation) / len(source)), for
+ sources of at least 20 characters. A row is an outlier when its ratio is
+ more than --length-threshold (default: 4) median absolute deviations away
+ from the median of its locale. --stats prints the median ratio of each
+ locale.
+"""
+
+import argparse
+import math
+import os
+import re
+import statistics
+import sys
+
+from functions import Inventory
+from locale_config import PROJECTS, get_locale_code, get_project_config
+from lxml import etree
+from xliff_cache import SOURCE_TAG, TARGET_TAG, TRANS_UNIT_TAG
+
+GROUP_TAG = "{urn:oasis:names:tc:xliff:document:1.2}group"
+PLURAL_RESTYPE = "x-gettext-plurals"
+
+# Qt placeholders: %1 to %99, optionally localized (%L1), and the plural
+# count %n (%Ln).
+PLACEHOLDER_RE = re.compile(r"%L?(?:[1-9][0-9]?|n)")
+PLURAL_PLACEHOLDERS = frozenset(("%n", "%Ln"))
+# Opening, closing and self-closing tags, as escaped text in the strings.
+TAG_RE = re.compile(r"<(/?)([A-Za-z][\w:.-]*)(?:\s[^<>]*?)?(/?)>")
+
+MIN_SOURCE_LENGTH = 20
+LENGTH_THRESHOLD = 4.0
+# Scale factor from the median absolute deviation to a standard deviation,
+# for normally distributed values.
+MAD_SCALE = 1.4826
+
+
+class TranslationTable:
+    """
+    Columnar table of the translations of several locales: one list per
+    column, with a row for each <trans-unit> with a source and a translation.
+    """
+
+    __slots__ = ("locales", "files", "ids", "sources", "targets", "plurals")
+
+    def __init__(self):
+        self.locales = []
+        self.files = []
+        self.ids = []
+        self.sources = []
+        self.targets = []
+        self.plurals = []
+
+    def add_tree(self, locale, filename, root):
+        """Add the translated units of a parsed file."""
+        for trans_node in root.iter(TRANS_UNIT_TAG):
+            source = target = None
+            for child in trans_node:
+                if child.tag == SOURCE_TAG and source is None:
+                    source = child.text
+                elif child.tag == TARGET_TAG and target is None:
+                    target = child.text
+            if not source or not target:
+                continue
+            parent = trans_node.getparent()
+            self.locales.append(locale)
+            self.files.append(filename)
+            self.ids.append(trans_node.get("id"))
+            self.sources.append(source)
+            self.targets.append(target)
+            self.plurals.append(
+                parent.tag == GROUP_TAG and parent.get("restype") == PLURAL_RESTYPE
+            )
+
+    def location(self, row):
+        return f"{self.locales[row]}/{self.files[row]} ({self.ids[row]})"
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def extract_translations(base_folder, reference_locale="en", excluded_folders=()):
+    """
+    Return (locales, table, parse_errors): the TranslationTable of all the
+    localized files in 'base_folder', and the files that couldn't be parsed.
+    """
+    inventory = Inventory(base_folder, excluded=excluded_folders)
+    locales = inventory.locales(skip={reference_locale})
+    table = TranslationTable()
+    parse_errors = []
+    for locale in locales:
+        for filename in inventory.locale_files(locale):
+            xliff_path = inventory.path(locale, filename)
+            try:
+                root = etree.parse(xliff_path).getroot()
+            except Exception as e:
+                parse_errors.append(f"{xliff_path}: can't parse ({e})")
+                continue
+            table.add_tree(locale, filename, root)
+    return locales, table, parse_errors
+
+
+def placeholders(text, plural=False):
+    """Return the sorted placeholders of a string (ignoring %n in plurals)."""
+    found = PLACEHOLDER_RE.findall(text)
+    if plural:
+        found = [name for name in found if name not in PLURAL_PLACEHOLDERS]
+    return sorted(found)
+
+
+def markup(text):
+    """
+    Return (tags, balanced): the sorted tags of a string, and whether they
+    are properly nested.
+    """
+    tags = []
+    stack = []
+    balanced = True
+    for match in TAG_RE.finditer(text):
+        closing, name, self_closing = match.groups()
+        tags.append(match.group(0))
+        if self_closing:
+            continue
+        if not closing:
+            stack.append(name)
+        elif stack and stack[-1] == name:
+            stack.pop()
+        else:
+            balanced = False
+    return sorted(tags), balanced and not stack
+
+
+def check_placeholders(table):
+    """Return the (row, source placeholders, target placeholders) mismatches."""
+    by_source = {}
+    errors = []
+    for row, (source, target, plural) in enumerate(
+        zip(table.sources, table.targets, table.plurals)
+    ):
+        key = (source, plural)
+        expected = by_source.get(key)
+        if expected is None:
+            expected = by_source[key] = placeholders(source, plural)
+        # Strings without placeholders aren't formatted with arg(), a '%' in
+        # the translation is literal (e.g. '%50' in Turkish).
+        if not expected:
+            continue
+        actual = placeholders(target, plural)
+        if actual != expected:
+            errors.append((row, expected, actual))
+    return errors
+
+
+def check_markup(table):
+    """
+    Return the (row, source tags, target tags, balanced) of translations whose
+    tags differ from the source, or aren't properly nested.
+    """
+    by_source = {}
+    errors = []
+    for row, (source, target) in enumerate(zip(table.sources, table.targets)):
+        expected = by_source.get(source)
+        if expected is None:
+            expected = by_source[source] = markup(source)
+        if not expected[0] and "<" not in target:
+            continue
+        tags, balanced = markup(target)
+        if tags != expected[0] or (expected[1] and not balanced):
+            errors.append((row, expected[0], tags, balanced))
+    return errors
+
+
+def length_outliers(table, threshold=LENGTH_THRESHOLD):
+    """
+    Return (outliers, stats): the (row, ratio, median ratio) of translations
+    with an unusual length ratio for their locale, and the (rows, median
+    ratio) of each locale.
+    """
+    by_locale = {}
+    for row, (locale, source, target) in enumerate(
+        zip(table.locales, table.sources, table.targets)
+    ):
+        if len(source) >= MIN_SOURCE_LENGTH:
+            rows, ratios = by_locale.setdefault(locale, ([], []))
+            rows.append(row)
+            ratios.append(math.log(len(target) / len(source)))
+
+    outliers = []
+    stats = {}
+    for locale, (rows, ratios) in by_locale.items():
+        center = statistics.median(ratios)
+        stats[locale] = (len(rows), math.exp(center))
+        spread = statistics.median([abs(ratio - center) for ratio in ratios])
+        limit = threshold * MAD_SCALE * spread
+        if limit == 0:
+            continue
+        for row, ratio in zip(rows, ratios):
+            if abs(ratio - center) > limit:
+                outliers.append((row, math.exp(ratio), math.exp(center)))
+    outliers.sort()
+    return outliers, stats
+
+
+def _list(values):
+    return " ".join(values) if values else "none"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--path",
+        required=True,
+        dest="base_folder",
+        help="Path to folder including subfolders for all locales",
+    )
+    parser.add_argument(
+        "--reference",
+        default="en",
+        dest="reference_locale",
+        help="Reference locale code to skip (default: en)",
+    )
+    parser.add_argument(
+        "--project",
+        default=None,
+        choices=sorted(PROJECTS),
+        help="Project config to use (locale mapping + excluded folders). "
+        "Defaults to no mapping and no excluded folders.",
+    )
+    parser.add_argument(
+        "--length-threshold",
+        default=LENGTH_THRESHOLD,
+        type=float,
+        help="Median absolute deviations of the length ratio beyond which a "
+        f"translation is reported (default: {LENGTH_THRESHOLD:g})",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print the median length ratio of each locale",
+    )
+    args = parser.parse_args()
+
+    config = get_project_config(args.project)
+    locales, table, parse_errors = extract_translations(
+        os.path.realpath(args.base_folder),
+        args.reference_locale,
+        config["excluded_folders"],
+    )
+    placeholder_errors = check_placeholders(table)
+    markup_errors = check_markup(table)
+    outliers, stats = length_outliers(table, args.length_threshold)
+
+    if args.stats:
+        print("Median length ratio by locale:")
+        for locale in locales:
+            if locale in stats:
+                rows, ratio = stats[locale]
+                code = get_locale_code(config["mapping"], locale)
+                print(f"  {locale} ({code}): {ratio:.2f} ({rows} strings)")
+
+    if outliers:
+        print("Unusual translation length (warnings):")
+        for row, ratio, center in outliers:
+            print(
+                f"  {table.location(row)}: {ratio:.2f} times the source length, "
+                f"{center:.2f} for the locale"
+            )
+
+    if parse_errors:
+        print("Files that could not be parsed:")
+        for error in parse_errors:
+            print(f"  {error}")
+
+    if placeholder_errors:
+        print("Placeholders that differ from the source:")
+        for row, expected, actual in placeholder_errors:
+            print(
+                f"  {table.location(row)}: source has {_list(expected)}, "
+                f"translation has {_list(actual)}"
+            )
+
+    if markup_errors:
+        print("Markup that differs from the source:")
+        for row, expected, actual, balanced in markup_errors:
+            nesting = "" if balanced else " (not properly nested)"
+            print(
+                f"  {table.location(row)}: source has {_list(expected)}, "
+                f"translation has {_list(actual)}{nesting}"
+            )
+
+    if parse_errors or placeholder_errors or markup_errors:
+        sys.exit(1)
+
+    print(f"{len(table)} translations are consistent in {len(locales)} locales.")
+
+
+if __name__ == "__main__":
+    main()
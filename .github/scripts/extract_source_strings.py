@@ -5,38 +5,278 @@
 
 # This script must be executed at the root of the repository.
 
-from functions import write_xliff
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from functions import UNIT_CONTAINER_TAGS, XLIFF_TAG, sort_children, write_xliff
+from glob import glob
+from instrumentation import (
+    add_profile_arguments,
+    enable_profiling,
+    profiler,
+    start_profiling,
+)
 from lxml import etree, objectify
+from ts_converter import convert_ts
 import argparse
+import io
 import os
 import re
+import shutil
+import sys
+import time
 
+XLIFF_NS = "urn:oasis:names:tc:xliff:document:1.2"
+FILE_TAG = f"{{{XLIFF_NS}}}file"
+TRANS_UNIT_TAG = f"{{{XLIFF_NS}}}trans-unit"
+SOURCE_TAG = f"{{{XLIFF_NS}}}source"
+TARGET_TAG = f"{{{XLIFF_NS}}}target"
+EXTRACOMMENT_TAG = f"{{{XLIFF_NS}}}extracomment"
+CONTEXT_GROUP_TAG = f"{{{XLIFF_NS}}}context-group"
+XML_SPACE_ATTR = "{http://www.w3.org/XML/1998/namespace}space"
 
-def get_node_key(node, attr=None):
-    if attr in node.attrib:
-        return f"{node.tag}:{node.get(attr)}"
-    return f"{node.tag}"
+# Changes caused by https://github.com/mozilla-l10n/mozilla-vpn-client-l10n/pull/268
+SRC_PATH_RE = re.compile(r"^src/")
+NEBULA_PATH_RE = re.compile(r"^nebula/")
+# Changes caused by https://github.com/mozilla-mobile/mozilla-vpn-client/pull/7924
+VPN_PATH_RE = re.compile(r"^../src/")
 
+# A normalization stage, applied by normalize_xliff() to every element whose
+# tag is in 'tags' (all elements if 'tags' is None). apply(node, in_file)
+# receives the element and whether it is (or is within) a <file>.
+# Stages with 'drop' set run before the element's children are visited, and
+# remove the element (skipping its children) when apply() returns True. The
+# others run after the children have been normalized, in the order listed.
+Stage = namedtuple("Stage", ["name", "tags", "apply", "drop"])
 
-def sort_children(node, attr=None):
-    node[:] = sorted(node, key=lambda child: get_node_key(child, attr))
-    for child in node:
-        sort_children(child, attr)
+
+def remove_node(node, in_file):
+    # Targets (i.e. translations) are removed, since this is the reference
+    # locale. Qt <context-group> elements are not used.
+    return True
+
+
+def remove_xml_space(node, in_file):
+    # The xml:space attribute in the <source> is not used when exporting back
+    # to .ts.
+    node.attrib.pop(XML_SPACE_ATTR, None)
+
+
+def extracomment_to_note(node, in_file):
+    node.tag = "note"
+
+
+def normalize_file_path(node, in_file):
+    if "original" not in node.attrib:
+        return
+
+    # Work around the change of file path caused by exporting translations
+    # in subfolders
+    # https://github.com/mozilla-mobile/mozilla-vpn-client/pull/1284
+    file_name = node.get("original")
+    file_name = SRC_PATH_RE.sub("../src/", file_name)
+    file_name = NEBULA_PATH_RE.sub("../../nebula/", file_name)
+    if not file_name.startswith("../src/apps/vpn/"):
+        file_name = VPN_PATH_RE.sub("../src/apps/vpn/", file_name)
+    if "i18nstrings_p.cpp" in file_name:
+        file_name = "generated/l18nstrings_p.cpp"
+
+    # Normalize path for strings generated from strings.yaml, removing "../"
+    # (more than once if necessary).
+    if "l18nstrings_p.cpp" in file_name:
+        while file_name.startswith("../"):
+            file_name = file_name.lstrip("../")
+    node.set("original", file_name)
+
+
+def set_target_language(node, in_file):
+    node.set("target-language", "en-US")
+
+
+STAGES = [
+    Stage("remove targets", {TARGET_TAG}, remove_node, True),
+    Stage("remove context groups", {CONTEXT_GROUP_TAG}, remove_node, True),
+    Stage("normalize file paths", {FILE_TAG}, normalize_file_path, False),
+    Stage("remove xml:space", {SOURCE_TAG}, remove_xml_space, False),
+    Stage("extracomment to note", {EXTRACOMMENT_TAG}, extracomment_to_note, False),
+    Stage("set target-language", {FILE_TAG}, set_target_language, False),
+    # Same order as functions.sort_xliff(): <file> elements by "original",
+    # <trans-unit> elements by "id". The content of <trans-unit> elements isn't
+    # sorted, lconvert already puts <note> elements after the <source>.
+    Stage("sort", {XLIFF_TAG, *UNIT_CONTAINER_TAGS}, sort_children, False),
+]
+
+
+def normalize_xliff(root, stages=STAGES, timings=None):
+    """
+    Clean up, in place, the XLIFF generated by lconvert for the reference
+    locale: normalize file paths, drop Qt-specific content and sort files and
+    trans-units.
+
+    All 'stages' are applied in a single traversal of the tree, visiting each
+    element once. If a 'timings' dict is provided, it's filled with the time
+    spent in each stage (in seconds).
+    """
+    if timings is not None:
+        start = time.perf_counter()
+    objectify.deannotate(root, cleanup_namespaces=True)
+    if timings is not None:
+        timings["deannotate"] = time.perf_counter() - start
+        stages = [
+            stage._replace(apply=_timed(stage.name, stage.apply, timings))
+            for stage in stages
+        ]
+
+    drop_stages = [stage for stage in stages if stage.drop]
+    other_stages = [stage for stage in stages if not stage.drop]
+
+    def visit(node, in_file):
+        in_file = in_file or node.tag == FILE_TAG
+        for child in list(node):
+            if not isinstance(child.tag, str):
+                # Comments and processing instructions are only sorted.
+                continue
+            if any(
+                (stage.tags is None or child.tag in stage.tags)
+                and stage.apply(child, in_file)
+                for stage in drop_stages
+            ):
+                node.remove(child)
+                continue
+            visit(child, in_file)
+        for stage in other_stages:
+            if stage.tags is None or node.tag in stage.tags:
+                stage.apply(node, in_file)
+
+    visit(root, False)
+
+
+def _timed(name, function, timings):
+    timings.setdefault(name, 0.0)
+
+    def wrapper(*args):
+        start = time.perf_counter()
+        result = function(*args)
+        timings[name] += time.perf_counter() - start
+        return result
+
+    return wrapper
+
+
+def extract_tree(input_path, output_file, converter, lib_path="", timings=False):
+    """
+    Convert a .ts file to XLIFF and return the root of the normalized tree,
+    without writing it. lconvert writes its output to 'output_file'.
+    """
+    print(f"Extracting strings in {output_file}")
+    if converter == "builtin":
+        try:
+            with profiler.stage("convert"):
+                root = convert_ts(input_path)
+                profiler.read(input_path)
+        except (OSError, ValueError, etree.XMLSyntaxError) as e:
+            sys.exit(f"Error converting {input_path}: {e}")
+    else:
+        exe_path = os.path.join(lib_path, "lconvert")
+        with profiler.stage("convert"):
+            os.system(f"{exe_path} -if ts -i {input_path} -of xlf -o {output_file}")
+        with profiler.stage("parse"):
+            root = etree.parse(output_file).getroot()
+            profiler.read(output_file)
+
+    # Clean up the new XLIFF file
+    stage_timings = {} if timings else None
+    with profiler.stage("normalize"):
+        normalize_xliff(root, timings=stage_timings)
+        if profiler.enabled:
+            profiler.units(sum(1 for _ in root.iter(TRANS_UNIT_TAG)))
+    if stage_timings is not None:
+        for name, duration in stage_timings.items():
+            print(f"  {name}: {duration * 1000:.1f} ms")
+
+    return root
+
+
+def extract_file(input_path, output_file, converter, lib_path="", timings=False):
+    """
+    Convert a .ts file to XLIFF, normalize it and write it to 'output_file'.
+    Return True if the file changed.
+    """
+    root = extract_tree(input_path, output_file, converter, lib_path, timings)
+
+    # Replace the existing local file with the new XML content
+    with profiler.stage("write"):
+        changed = write_xliff(root, output_file)
+        if changed:
+            profiler.wrote(output_file)
+    return changed
+
+
+def map_input_folder(input_folder, output_folder):
+    """
+    Map each .ts file in 'input_folder' to '<output_folder>/<name>/strings.xliff',
+    and remove the subfolders of 'output_folder' without a matching .ts file
+    (i.e. obsolete addons). Return the list of (input, output) pairs.
+    """
+    pairs = []
+    names = set()
+    for input_path in sorted(glob(os.path.join(input_folder, "*.ts"))):
+        name = os.path.splitext(os.path.basename(input_path))[0]
+        names.add(name)
+        pairs.append((input_path, os.path.join(output_folder, name, "strings.xliff")))
+
+    if os.path.isdir(output_folder):
+        for entry in sorted(os.scandir(output_folder), key=lambda e: e.name):
+            if entry.is_dir() and entry.name not in names:
+                print(f"Removing obsolete folder {entry.path}")
+                shutil.rmtree(entry.path)
+
+    for _, output_file in pairs:
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    return pairs
+
+
+def _extract_in_worker(task):
+    """
+    Run extract_file() in a worker, and return (changed, output, stats) so the
+    main process can print the log lines in the same order as a serial run,
+    and add the profiler statistics (None if not profiling) to its own.
+    """
+    output = io.StringIO()
+    with redirect_stdout(output):
+        changed = extract_file(*task)
+    return changed, output.getvalue(), profiler.take()
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--input",
-        required=True,
-        dest="input_path",
-        help="Path to the .ts file to import strings from.",
+        action="append",
+        default=[],
+        dest="input_paths",
+        help="Path to the .ts file to import strings from (can be repeated, "
+        "paired in order with --output).",
     )
     parser.add_argument(
         "--output",
-        required=True,
-        dest="output_file",
-        help="Path to the output XLIFF file",
+        action="append",
+        default=[],
+        dest="output_files",
+        help="Path to the output XLIFF file (can be repeated)",
+    )
+    parser.add_argument(
+        "--input-dir",
+        dest="input_folder",
+        help="Folder of .ts files, each extracted to "
+        "<output-dir>/<name>/strings.xliff. Subfolders of the output folder "
+        "without a .ts file are removed.",
+    )
+    parser.add_argument(
+        "--output-dir",
+        dest="output_folder",
+        help="Output folder for --input-dir",
     )
     parser.add_argument(
         "--lib",
@@ -45,87 +285,55 @@ def main():
         dest="lib_path",
         help="Path to qt libraries",
     )
+    parser.add_argument(
+        "--converter",
+        choices=["lconvert", "builtin"],
+        default="lconvert",
+        help="Convert the .ts file with Qt's lconvert (default), or in-process "
+        "without requiring Qt",
+    )
+    parser.add_argument(
+        "--jobs",
+        default=1,
+        type=int,
+        help="Number of worker processes (default: 1, serial; 0: one per CPU)",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print the time spent in each normalization stage",
+    )
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    start_profiling(args, "extract_source_strings")
 
-    output_xliff_file = args.output_file
-
-    # Update English XLIFF file
-    print(f"Extracting strings in {output_xliff_file}")
-    exe_path = os.path.join(args.lib_path, "lconvert")
-    os.system(f"{exe_path} -if ts -i {args.input_path} -of xlf -o {output_xliff_file}")
-
-    # Clean up the new XLIFF file
-    NS = {"x": "urn:oasis:names:tc:xliff:document:1.2"}
-    tree = etree.parse(output_xliff_file)
-    root = tree.getroot()
-    objectify.deannotate(root, cleanup_namespaces=True)
-
-    # Work around the change of file path caused by exporting translations
-    # in subfolders
-    # https://github.com/mozilla-mobile/mozilla-vpn-client/pull/1284
-    for f in root.xpath("//x:file", namespaces=NS):
-        if "original" in f.attrib:
-            file_name = f.get("original")
-            # Changes caused by https://github.com/mozilla-l10n/mozilla-vpn-client-l10n/pull/268
-            file_name = re.sub(r"^src/", "../src/", file_name)
-            file_name = re.sub(r"^nebula/", "../../nebula/", file_name)
-            # Changes caused by https://github.com/mozilla-mobile/mozilla-vpn-client/pull/7924
-            if not file_name.startswith("../src/apps/vpn/"):
-                file_name = re.sub(r"^../src/", "../src/apps/vpn/", file_name)
-            if "i18nstrings_p.cpp" in file_name:
-                file_name = "generated/l18nstrings_p.cpp"
-            f.set("original", file_name)
-
-    # Normalize path for strings generated from strings.yaml, removing "../"
-    # (more than once if necessary).
-    for f in root.xpath("//x:file", namespaces=NS):
-        if "original" in f.attrib:
-            file_name = f.get("original")
-            if "l18nstrings_p.cpp" in file_name:
-                while file_name.startswith("../"):
-                    file_name = file_name.lstrip("../")
-                f.set("original", file_name)
-
-    # Remove targets (i.e. translations) if present, since this is the reference
-    # locale
-    for target in root.xpath("//x:target", namespaces=NS):
-        if target is not None:
-            target.getparent().remove(target)
-
-    # Remove the xml:space attribute in the <source>, since it's not used when
-    # exporting back to .ts
-    for source in root.xpath("//x:source", namespaces=NS):
-        attrib_name = "{http://www.w3.org/XML/1998/namespace}space"
-        source.attrib.pop(attrib_name)
-
-    # Change QT <extracomment> elements into <notes>
-    for extracomment in root.xpath("//x:extracomment", namespaces=NS):
-        extracomment.tag = "note"
-
-    # Remove all <context-group> elements
-    for context_group in root.xpath("//x:context-group", namespaces=NS):
-        context_group.getparent().remove(context_group)
-
-    # Add target language
-    for file_node in root.xpath("//x:file", namespaces=NS):
-        file_node.set("target-language", "en-US")
-
-    # Sort file elements by "original" attribute
-    sort_children(root, "original")
-    # Sort trans-unit elements by IDs within each file element
-    for f in root.xpath("//x:file", namespaces=NS):
-        sort_children(f, "id")
-
-    # Ensure note elements appear after source in each trans-unit
-    # (sort_children sorts alphabetically, which puts "note" before "source")
-    for trans_unit in root.xpath("//x:trans-unit", namespaces=NS):
-        notes = trans_unit.findall("{urn:oasis:names:tc:xliff:document:1.2}note")
-        for note in notes:
-            trans_unit.remove(note)
-            trans_unit.append(note)
+    if len(args.input_paths) != len(args.output_files):
+        parser.error("--input and --output must be provided in pairs")
+    if bool(args.input_folder) != bool(args.output_folder):
+        parser.error("--input-dir and --output-dir must be used together")
+    pairs = list(zip(args.input_paths, args.output_files))
+    if args.input_folder:
+        pairs += map_input_folder(args.input_folder, args.output_folder)
+    elif not pairs:
+        parser.error("either --input/--output or --input-dir/--output-dir is required")
 
-    # Replace the existing local file with the new XML content
-    write_xliff(root, output_xliff_file)
+    tasks = [
+        (input_path, output_file, args.converter, args.lib_path, args.timings)
+        for input_path, output_file in pairs
+    ]
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    if jobs == 1 or len(tasks) < 2:
+        for task in tasks:
+            extract_file(*task)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=enable_profiling if profiler.enabled else None,
+        ) as executor:
+            # map() yields results in task order, keeping the log deterministic.
+            for _, output, stats in executor.map(_extract_in_worker, tasks):
+                print(output, end="")
+                profiler.merge(stats)
 
 
 if __name__ == "__main__":
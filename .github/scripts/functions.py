@@ -4,30 +4,129 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import os
+import re
+import shutil
+import tempfile
+from filecmp import cmp
 
 from lxml import etree
 
+XLIFF_NS = "urn:oasis:names:tc:xliff:document:1.2"
+XLIFF_TAG = f"{{{XLIFF_NS}}}xliff"
+TRANS_UNIT_TAG = f"{{{XLIFF_NS}}}trans-unit"
+FILE_TAG = f"{{{XLIFF_NS}}}file"
+BODY_TAG = f"{{{XLIFF_NS}}}body"
+GROUP_TAG = f"{{{XLIFF_NS}}}group"
+XML_DECLARATION = b'<?xml version="1.0" encoding="utf-8"?>\n'
+
+# Namespace declarations that lxml adds to the first tag when serializing a
+# subelement on its own.
+NS_DECLARATIONS_RE = re.compile(rb'^(<[^\s/>]+)(?:\s+xmlns(?::[^\s=]+)?="[^"]*")+')
+
 
 def write_xliff(root, filename):
-    with open(filename, "w+") as fp:
-        # Fix indentation of XML file
-        etree.indent(root)
-        """
-        Hack to avoid conflicts with Pontoon, which uses single quotes
-        for the XML declaration:
-            1. Exclude the XML declaration when using etree.tostring()
-            2. Manually add the declaration with double quotes
-        """
+    """
+    Serialize `root` to `filename`, and return True if the file was written.
+
+    The file is left untouched (same content and mtime) when its current
+    content is already identical to the serialized tree, so unchanged files
+    don't cost a write.
+    """
+    # Fix indentation of XML file
+    etree.indent(root)
+    """
+    Hack to avoid conflicts with Pontoon, which uses single quotes
+    for the XML declaration:
+        1. Exclude the XML declaration when using etree.tostring()
+        2. Write the declaration with double quotes before the content
+    """
+    if isinstance(root, etree._ElementTree) and (
+        root.docinfo.doctype
+        or root.getroot().getprevious() is not None
+        or root.getroot().getnext() is not None
+    ):
+        # pretty_print also puts the nodes around the root on their own line.
         xliff_content = etree.tostring(
             root,
             encoding="UTF-8",
             xml_declaration=False,
             pretty_print=True,
         )
-        xliff_content = (
-            '<?xml version="1.0" encoding="utf-8"?>\n' + xliff_content.decode("utf-8")
-        )
-        fp.write(xliff_content)
+    else:
+        # Once indented, pretty_print would only add the final line break.
+        xliff_content = etree.tostring(root, encoding="UTF-8") + b"\n"
+    return write_content(xliff_content, filename, header=XML_DECLARATION)
+
+
+def write_content(content, filename, header=b""):
+    """
+    Write the bytes 'header' and 'content' to 'filename' unless the file
+    already has that exact content, and return True if the file was written.
+    """
+    # Only read the existing file back if the size matches.
+    try:
+        if os.path.getsize(filename) == len(header) + len(content):
+            with open(filename, "rb") as fp:
+                if fp.read(len(header)) == header and fp.read() == content:
+                    return False
+    except OSError:
+        pass
+
+    with open(filename, "wb") as fp:
+        fp.write(header)
+        fp.write(content)
+    return True
+
+
+# Canonical order of the reference files (see sort_xliff): the children of the
+# root are sorted by tag and 'original', the children of <file> elements and of
+# the elements containing <trans-unit> elements by tag, 'id' and 'original'.
+ROOT_SORT_ATTRS = ("original",)
+FILE_SORT_ATTRS = ("id", "original")
+UNIT_CONTAINER_TAGS = frozenset((FILE_TAG, BODY_TAG, GROUP_TAG))
+
+
+def sort_key(node, attrs):
+    """
+    Return the sort key of 'node': its tag, then the value of each attribute
+    in 'attrs', a missing attribute sorting before any value. Comments and
+    processing instructions sort first.
+    """
+    if not isinstance(node.tag, str):
+        return ("",)
+    key = [node.tag]
+    for attr in attrs:
+        value = node.get(attr)
+        key.append(() if value is None else (value,))
+    return tuple(key)
+
+
+def sort_children(node, in_file):
+    """
+    Sort the children of 'node' (stable), with the keys of the root's children,
+    or of a <file> element and its descendants if 'in_file'.
+    """
+    attrs = FILE_SORT_ATTRS if in_file else ROOT_SORT_ATTRS
+    children = list(node)
+    ordered = sorted(children, key=lambda child: sort_key(child, attrs))
+    if ordered != children:
+        node[:] = ordered
+
+
+def sort_xliff(root):
+    """
+    Sort an XLIFF tree, in place, in the canonical order of the reference
+    files: <file> elements by 'original', and <trans-unit> elements by 'id'
+    within their <body> (or <group>). Only the root and the elements that
+    contain <trans-unit> elements are sorted, the content of other elements
+    (e.g. the <source> and <note> of a <trans-unit>) keeps its order.
+    """
+    sort_children(root, False)
+    containers = [child for child in root if child.tag == FILE_TAG]
+    while containers:
+        node = containers.pop()
+        sort_children(node, True)
+        containers += [child for child in node if child.tag in UNIT_CONTAINER_TAGS]
 
 
 def list_locales(base_folder, excluded=(), skip=()):
@@ -46,3 +145,246 @@ def list_locales(base_folder, excluded=(), skip=()):
         and d not in excluded
         and d not in skip
     )
+
+
+def find_xliff_files(folder):
+    """
+    Return a {relative_path: os.DirEntry} dict of the XLIFF files in 'folder'
+    and its subfolders, in the same order as a recursive glob("**/*.xliff")
+    (hidden files and folders are skipped too). DirEntry.stat() caches the
+    stat data of each file.
+    """
+    files = {}
+
+    def walk(path, prefix):
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return
+        subfolders = []
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                subfolders.append(entry)
+            elif entry.name.endswith(".xliff"):
+                files[prefix + entry.name] = entry
+        for entry in subfolders:
+            walk(entry.path, prefix + entry.name + os.sep)
+
+    walk(folder, "")
+    return files
+
+
+class Inventory:
+    """
+    Locale folders of 'base_folder' and their XLIFF files, collected with a
+    single os.scandir() walk instead of listing and globbing each folder
+    separately. Hidden folders, and folders listed in 'excluded', are not
+    scanned.
+    """
+
+    def __init__(self, base_folder, excluded=()):
+        self.base_folder = base_folder
+        excluded = set(excluded)
+        self.files = {
+            entry.name: find_xliff_files(entry.path)
+            for entry in sorted(os.scandir(base_folder), key=lambda e: e.name)
+            if entry.is_dir()
+            and not entry.name.startswith(".")
+            and entry.name not in excluded
+        }
+
+    def locales(self, skip=()):
+        """Return the sorted locale folder names, except those in 'skip'."""
+        skip = set(skip)
+        return [locale for locale in self.files if locale not in skip]
+
+    def locale_files(self, locale):
+        """
+        Return the {relative_path: os.DirEntry} dict of a locale's XLIFF
+        files (empty for a missing locale).
+        """
+        return self.files.get(locale, {})
+
+    def has_file(self, locale, filename):
+        return filename in self.files.get(locale, ())
+
+    def path(self, locale, filename):
+        return os.path.join(self.base_folder, locale, filename)
+
+
+class _StreamUnsupported(Exception):
+    pass
+
+
+def is_whitespace(text):
+    # Same test etree.indent() uses to decide if text can be replaced.
+    return not (text and text.strip())
+
+
+def escape_text(text):
+    node = etree.Element("x")
+    node.text = text
+    return etree.tostring(node, encoding="UTF-8")[3:-4]
+
+
+def indented_text(text, level):
+    """
+    Serialize the text before a node at depth 'level' (or before the end tag
+    of its parent, at depth 'level' + 1), as etree.indent() leaves it: replaced
+    by the indentation if it's only whitespace, and kept otherwise.
+    """
+    if is_whitespace(text):
+        return b"\n" + b"  " * level
+    return escape_text(text)
+
+
+def _check_namespaces(node):
+    parent = node.getparent()
+    if parent is not None and node.nsmap != parent.nsmap:
+        # Declarations below the root can't be told apart from the ones lxml
+        # adds when serializing a subelement.
+        raise _StreamUnsupported
+
+
+def serialize_node(node, level):
+    """
+    Serialize a complete node (and its children) without its tail, indented as
+    etree.indent() would indent it at depth 'level' in the whole document.
+    """
+    if not isinstance(node.tag, str):
+        # Comment or processing instruction.
+        return etree.tostring(node, encoding="UTF-8", with_tail=False)
+    if len(node):
+        etree.indent(node, level=level)
+    data = etree.tostring(node, encoding="UTF-8", with_tail=False)
+    if level == 0:
+        # The root keeps its own namespace declarations.
+        return data
+    return NS_DECLARATIONS_RE.sub(rb"\1", data, count=1)
+
+
+def start_tag(node, is_root):
+    shallow = etree.Element(node.tag, attrib=dict(node.attrib), nsmap=node.nsmap)
+    data = etree.tostring(shallow, encoding="UTF-8")
+    if not is_root:
+        data = NS_DECLARATIONS_RE.sub(rb"\1", data, count=1)
+    # Turn the empty element '<tag .../>' into a start tag.
+    return data[:-2] + b">"
+
+
+class _StreamFrame:
+    """An open element in stream_xliff(), whose children are streamed."""
+
+    __slots__ = ("node", "level", "start_tag", "end_tag", "last_child")
+
+    def __init__(self, node, level):
+        self.node = node
+        self.level = level
+        self.start_tag = start_tag(node, level == 0)
+        name = self.start_tag[1:].split(b">")[0].split()[0]
+        self.end_tag = b"</" + name + b">"
+        self.last_child = None
+
+
+def _open_child(frame, output):
+    """
+    Write what precedes a new child of 'frame': the start tag and text of the
+    parent for the first child, or the previous sibling's tail otherwise.
+    """
+    if frame.last_child is None:
+        output.write(frame.start_tag)
+        text = frame.node.text
+    else:
+        text = frame.last_child.tail
+        # The previous sibling is fully written, drop it to bound memory.
+        frame.node.remove(frame.last_child)
+    output.write(indented_text(text, frame.level + 1))
+
+
+def _stream_nodes(filename, process_unit, output):
+    stack = []
+    file_node = None
+    # Depth inside the <trans-unit> being parsed (0 when outside one).
+    unit_depth = 0
+    for event, node in etree.iterparse(
+        filename, events=("start", "end", "comment", "pi")
+    ):
+        if unit_depth:
+            # Children of a <trans-unit> are serialized with it.
+            if event == "start":
+                unit_depth += 1
+            elif event == "end":
+                unit_depth -= 1
+                if unit_depth == 0:
+                    if file_node is not None:
+                        process_unit(node, file_node)
+                    output.write(serialize_node(node, len(stack)))
+                    stack[-1].last_child = node
+        elif not stack:
+            if event != "start" or node.getroottree().docinfo.doctype:
+                # DOCTYPE, or comment/processing instruction outside the root.
+                raise _StreamUnsupported
+            stack.append(_StreamFrame(node, 0))
+        elif event == "start":
+            _check_namespaces(node)
+            _open_child(stack[-1], output)
+            if node.tag == TRANS_UNIT_TAG:
+                unit_depth = 1
+            else:
+                stack.append(_StreamFrame(node, len(stack)))
+                if node.tag == FILE_TAG:
+                    file_node = node
+        elif event == "end":
+            frame = stack.pop()
+            if frame.last_child is None:
+                # No children: written as a whole, like a <trans-unit>.
+                output.write(serialize_node(node, frame.level))
+            else:
+                output.write(indented_text(frame.last_child.tail, frame.level))
+                output.write(frame.end_tag)
+            if node is file_node:
+                file_node = None
+            if stack:
+                stack[-1].last_child = node
+        else:
+            # Comment or processing instruction between elements.
+            _open_child(stack[-1], output)
+            output.write(serialize_node(node, len(stack)))
+            stack[-1].last_child = node
+
+    output.write(b"\n")
+
+
+def stream_xliff(filename, process_unit):
+    """
+    Rewrite 'filename' while streaming it with etree.iterparse, calling
+    process_unit(trans_node, file_node) on every <trans-unit> within a <file>
+    as soon as it's fully parsed. Only the open elements and the current
+    <trans-unit> are kept in memory, and the output is byte-identical to
+    parsing the whole file, applying the same changes and using write_xliff().
+
+    Return True if the file was written, False if its content didn't change,
+    and None (leaving the file untouched) for content the streaming writer
+    doesn't support, i.e. a DOCTYPE, nodes outside the root element or
+    namespace declarations below it. In that case the caller should fall back
+    to parsing the whole tree.
+    """
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as output:
+            output.write(XML_DECLARATION)
+            _stream_nodes(filename, process_unit, output)
+        if cmp(temp_path, filename, shallow=False):
+            return False
+        shutil.copymode(filename, temp_path)
+        os.replace(temp_path, filename)
+        return True
+    except _StreamUnsupported:
+        return None
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
@@ -0,0 +1,236 @@
+#! /usr/bin/env python3
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Opt-in instrumentation of the hot paths of the scripts.
+
+Scripts call add_profile_arguments() on their parser, then start_profiling().
+With --profile <report.json> (or the L10N_PROFILE environment variable), the
+wall time, files parsed, bytes read and written, trans-units visited and peak
+RSS of each stage (parse, index, update, carry-over, write...) are saved as a
+JSON report when the script exits. With --cprofile <file> (or L10N_CPROFILE),
+cProfile statistics of the main process are saved too, e.g. for pstats.
+
+Code measures a stage, and records what it does, with:
+
+    with profiler.stage("parse"):
+        tree = etree.parse(path)
+        profiler.read(path)
+
+Counters go to the innermost running stage, and the time of a nested stage
+is not counted in its parent, so stage times add up. When profiling is
+disabled, these calls return immediately.
+
+Worker processes call enable_profiling() if the main process profiles, and
+send profiler.take() back with their results, for profiler.merge().
+"""
+
+import atexit
+import cProfile
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+PROFILE_ENV = "L10N_PROFILE"
+CPROFILE_ENV = "L10N_CPROFILE"
+COUNTERS = (
+    "calls",
+    "files_parsed",
+    "bytes_read",
+    "files_written",
+    "bytes_written",
+    "trans_units",
+)
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in KiB, or None."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere.
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _max(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Stage:
+    __slots__ = ("profiler", "stats", "start", "nested")
+
+    def __init__(self, profiler, stats):
+        self.profiler = profiler
+        self.stats = stats
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.nested = 0.0
+        self.profiler._running.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        running = self.profiler._running
+        running.pop()
+        if running:
+            running[-1].nested += elapsed
+        self.stats["seconds"] += elapsed - self.nested
+        self.stats["calls"] += 1
+        self.stats["peak_rss_kb"] = _max(self.stats["peak_rss_kb"], peak_rss())
+        return False
+
+
+class Profiler:
+    """Statistics of each stage, collected only once enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+        self._running = []
+
+    def stage(self, name):
+        """Return a context manager measuring the stage 'name'."""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, self._stats(name))
+
+    def _stats(self, name):
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = dict.fromkeys(COUNTERS, 0)
+            stats.update(seconds=0.0, peak_rss_kb=None)
+            self.stages[name] = stats
+        return stats
+
+    def _count(self, counter, value):
+        if self._running:
+            self._running[-1].stats[counter] += value
+        else:
+            self._stats("other")[counter] += value
+
+    def read(self, path):
+        """Count 'path' as a parsed file."""
+        if self.enabled:
+            self._count("files_parsed", 1)
+            self._count("bytes_read", os.path.getsize(path))
+
+    def wrote(self, path):
+        """Count 'path' as a written file."""
+        if self.enabled:
+            self._count("files_written", 1)
+            self._count("bytes_written", os.path.getsize(path))
+
+    def units(self, count):
+        """Count 'count' trans-units as visited."""
+        if self.enabled:
+            self._count("trans_units", count)
+
+    def take(self):
+        """Return the statistics collected so far (None if disabled), and reset."""
+        if not self.enabled:
+            return None
+        stages = self.stages
+        self.stages = {}
+        return stages
+
+    def merge(self, stages):
+        """Add the statistics returned by take() in another process."""
+        if not stages:
+            return
+        for name, other in stages.items():
+            stats = self._stats(name)
+            for counter in COUNTERS:
+                stats[counter] += other[counter]
+            stats["seconds"] += other["seconds"]
+            stats["peak_rss_kb"] = _max(stats["peak_rss_kb"], other["peak_rss_kb"])
+
+
+profiler = Profiler()
+_NULL_STAGE = _NullStage()
+
+
+def enable_profiling():
+    """Enable the profiler, e.g. as the initializer of worker processes."""
+    profiler.enabled = True
+
+
+def add_profile_arguments(parser):
+    parser.add_argument(
+        "--profile",
+        metavar="REPORT",
+        default=None,
+        help="Save a JSON report of the time and resources used by each stage "
+        f"(default: ${PROFILE_ENV}, if set)",
+    )
+    parser.add_argument(
+        "--cprofile",
+        metavar="STATS",
+        default=None,
+        help="Save cProfile statistics of the main process "
+        f"(default: ${CPROFILE_ENV}, if set)",
+    )
+
+
+def start_profiling(args, script):
+    """
+    Start profiling if requested by the command line 'args' or the
+    environment, and save the results when the process exits.
+    """
+    report_path = args.profile or os.environ.get(PROFILE_ENV)
+    cprofile_path = args.cprofile or os.environ.get(CPROFILE_ENV)
+    if not report_path and not cprofile_path:
+        return
+
+    if report_path:
+        enable_profiling()
+    cprofile = None
+    if cprofile_path:
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+    pid = os.getpid()
+    start = time.perf_counter()
+
+    def save():
+        if os.getpid() != pid:
+            # Forked worker process.
+            return
+        if cprofile is not None:
+            cprofile.disable()
+            cprofile.dump_stats(cprofile_path)
+        if report_path:
+            children = None
+            if resource is not None:
+                children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+                if sys.platform == "darwin":
+                    children //= 1024
+            report = {
+                "script": script,
+                "args": sys.argv[1:],
+                "wall_seconds": time.perf_counter() - start,
+                "peak_rss_kb": peak_rss(),
+                "children_peak_rss_kb": children or None,
+                "stages": profiler.stages,
+            }
+            with open(report_path, "w") as fp:
+                json.dump(report, fp, indent=1)
+                fp.write("\n")
+
+    atexit.register(save)
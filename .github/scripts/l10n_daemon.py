@@ -0,0 +1,524 @@
+#! /usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+l10n_daemon.py serve --path <folder> [--reference <locale>] [--project <name>]
+     [--interval <seconds>] [--socket <path>]
+l10n_daemon.py update --path <folder> [--type standard|nofile|matchid]
+     [--fill-from-tm] [--socket <path>]
+l10n_daemon.py check|status|stop --path <folder> [--socket <path>]
+
+ Keep the XLIFF trees of a localization folder in memory across runs, for
+ repeated manual updates and checks (e.g. while reviewing a 'nofile' run),
+ without paying for the interpreter start, the imports and a parse of every
+ file each time.
+
+ 'serve' parses all the XLIFF files of the reference and locale folders, and
+ listens on a local socket (.cache/l10n_daemon.sock in the path by default).
+ The folder is polled for changes every 'interval' seconds, and before each
+ command: only the trees of files added or changed on disk are parsed again.
+
+ The other commands are sent to the daemon, which prints the same output as
+ the matching script:
+ - update: update_other_locales.py. Only the localized files whose reference
+   file or content changed since the previous update of the same type are
+   processed (with --fill-from-tm, all the files of a locale with a change).
+   The first update processes every file. Files that can't be parsed make the
+   command fail, and are processed again by the next update.
+ - check: check_target_language.py, checking again only the changed files.
+ - status: files and trees in memory.
+ - stop: stop the daemon.
+"""
+
+import argparse
+import io
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+from contextlib import redirect_stdout
+
+from check_target_language import language_errors, print_report, tree_languages
+from functions import Inventory
+from locale_config import PROJECTS, get_locale_code, get_project_config
+from lxml import etree
+from translation_memory import TranslationMemory
+from update_other_locales import UPDATE_TYPES, load_reference, update_locale_file
+from xliff_cache import CACHE_FOLDER
+
+SOCKET_NAME = "l10n_daemon.sock"
+COMMANDS = ("serve", "update", "check", "status", "stop")
+
+
+def default_socket_path(base_folder):
+    return os.path.join(base_folder, CACHE_FOLDER, SOCKET_NAME)
+
+
+def file_signature(path):
+    """Return the stat data telling if a file changed, or None if missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+class TreeStore:
+    """
+    Parsed trees of the XLIFF files in the locale folders of 'base_folder',
+    by path. Trees are parsed on first use, and dropped when refresh() finds
+    that their file changed on disk.
+    """
+
+    def __init__(self, base_folder, excluded=()):
+        self.base_folder = base_folder
+        self.excluded = excluded
+        self.inventory = None
+        # {path: signature} as of the last refresh().
+        self.signatures = {}
+        # {path: tree}, or the parse error of the file.
+        self.trees = {}
+
+    def refresh(self):
+        """
+        Scan the folder again, and return the set of paths added, changed or
+        removed since the previous scan.
+        """
+        inventory = Inventory(self.base_folder, excluded=self.excluded)
+        signatures = {}
+        for locale in inventory.locales():
+            for filename in inventory.locale_files(locale):
+                path = inventory.path(locale, filename)
+                signature = file_signature(path)
+                if signature is not None:
+                    signatures[path] = signature
+
+        changed = {
+            path
+            for path in signatures.keys() | self.signatures.keys()
+            if signatures.get(path) != self.signatures.get(path)
+        }
+        for path in changed:
+            self.trees.pop(path, None)
+        self.inventory = inventory
+        self.signatures = signatures
+        return changed
+
+    def tree(self, path):
+        """Return the parsed tree of 'path'. Parse errors are raised."""
+        tree = self.trees.get(path)
+        if tree is None:
+            try:
+                tree = etree.parse(path)
+            except Exception as e:
+                tree = e
+            self.trees[path] = tree
+        if isinstance(tree, Exception):
+            raise tree
+        return tree
+
+    def load(self, paths):
+        """Parse the trees of 'paths' in advance, ignoring parse errors."""
+        for path in paths:
+            if path in self.signatures:
+                try:
+                    self.tree(path)
+                except Exception:
+                    pass
+
+    def discard(self, path):
+        """Drop the tree of 'path', e.g. after it was modified in memory."""
+        self.trees.pop(path, None)
+
+
+class Daemon:
+    """The state shared by the commands of a daemon, and their implementation."""
+
+    def __init__(self, base_folder, reference_locale, config):
+        self.base_folder = base_folder
+        self.reference_locale = reference_locale
+        self.mapping = config["mapping"]
+        self.store = TreeStore(base_folder, excluded=config["excluded_folders"])
+        # {(update_type, fill_from_tm): {path: signature}} after each update.
+        self.baselines = {}
+        # {(update_type, filename): (signature, reference)}
+        self.references = {}
+        # {path: ((signature, expected), parse_errors, target_errors)}
+        self.checks = {}
+
+    def poll(self):
+        """Parse the files changed on disk since the last refresh."""
+        changed = self.store.refresh()
+        if changed:
+            self.store.load(sorted(changed))
+            print(f"{len(changed)} files changed on disk.", flush=True)
+
+    def reference(self, filename, update_type):
+        """Return what update_locale_file() needs for a reference file."""
+        path = self.store.inventory.path(self.reference_locale, filename)
+        signature = self.store.signatures.get(path)
+        cached = self.references.get((update_type, filename))
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        try:
+            reference_tree = self.store.tree(path)
+        except Exception as e:
+            sys.exit(f"ERROR: Can't parse reference file {filename}\n{e}")
+        reference = load_reference(
+            self.base_folder,
+            self.reference_locale,
+            filename,
+            update_type,
+            reference_trees={filename: reference_tree},
+        )
+        self.references[(update_type, filename)] = (signature, reference)
+        return reference
+
+    def translation_memory(self, locale):
+        """Return the TranslationMemory of a locale, from the trees in memory."""
+        inventory = self.store.inventory
+        translation_memory = TranslationMemory()
+        for filename in inventory.locale_files(locale):
+            try:
+                root = self.store.tree(inventory.path(locale, filename)).getroot()
+            except Exception:
+                continue
+            translation_memory.add_tree(filename, root)
+        return translation_memory
+
+    def update(self, update_type="standard", fill_from_tm=False):
+        """Run update_other_locales.py on the files affected by changes."""
+        inventory = self.store.inventory
+        reference_files = list(inventory.locale_files(self.reference_locale))
+        if not reference_files:
+            print(
+                "No reference file found in "
+                f"{os.path.join(self.base_folder, self.reference_locale)}"
+            )
+            return 1
+        locales = inventory.locales(skip={self.reference_locale})
+
+        signatures = self.store.signatures
+        key = (update_type, fill_from_tm)
+        baseline = self.baselines.get(key, {})
+
+        def changed(locale, filename):
+            path = inventory.path(locale, filename)
+            return baseline.get(path) != signatures.get(path)
+
+        # The update of a localized file only depends on its reference file
+        # and on its own content, unless translations come from the whole
+        # locale.
+        dirty_locales = set()
+        if fill_from_tm:
+            dirty_locales = {
+                locale
+                for locale in locales
+                if any(
+                    changed(locale, filename)
+                    for filename in inventory.locale_files(locale)
+                )
+            }
+        tasks = []
+        for filename in reference_files:
+            reference_changed = changed(self.reference_locale, filename)
+            for locale in locales:
+                if inventory.has_file(locale, filename) and (
+                    reference_changed
+                    or locale in dirty_locales
+                    or changed(locale, filename)
+                ):
+                    tasks.append((filename, locale))
+
+        new_baseline = dict(signatures)
+        if not tasks:
+            self.baselines[key] = new_baseline
+            print("No changes since the last update, nothing to update.")
+            return 0
+
+        # Built before updating any file, like update_locales() does.
+        memories = {}
+        if fill_from_tm:
+            for locale in sorted({locale for _, locale in tasks}):
+                memories[locale] = self.translation_memory(locale)
+
+        updated_files = 0
+        changed_files = 0
+        failed_files = 0
+        for filename, locale in tasks:
+            reference = self.reference(filename, update_type)
+            path = inventory.path(locale, filename)
+            try:
+                locale_tree = self.store.tree(path)
+            except Exception as e:
+                print(f"ERROR: Can't parse {path}")
+                print(e)
+                # Left out of the baseline, to be processed again by the next
+                # update.
+                new_baseline.pop(path, None)
+                failed_files += 1
+                continue
+            processed, changed_file = update_locale_file(
+                reference,
+                self.base_folder,
+                filename,
+                locale,
+                update_type,
+                self.mapping,
+                translation_memory=memories.get(locale),
+                locale_tree=locale_tree,
+            )
+            updated_files += processed
+            changed_files += changed_file
+            if not processed:
+                new_baseline.pop(path, None)
+                failed_files += 1
+            # 'standard' updates the tree in place, it still matches the file
+            # if it wasn't written. Rebuild modes may have moved its nodes.
+            if changed_file or update_type != "standard":
+                self.store.discard(path)
+            if changed_file:
+                new_baseline[path] = file_signature(path)
+        self.baselines[key] = new_baseline
+
+        print(f"{updated_files} files processed, {changed_files} changed.")
+        return 1 if failed_files else 0
+
+    def check(self):
+        """Run check_target_language.py, checking only changed files again."""
+        inventory = self.store.inventory
+        locales = inventory.locales(skip={self.reference_locale})
+        checks = {}
+        parse_errors = []
+        target_errors = []
+        for locale in locales:
+            expected = get_locale_code(self.mapping, locale)
+            for filename in inventory.locale_files(locale):
+                path = inventory.path(locale, filename)
+                state = (self.store.signatures.get(path), expected)
+                result = self.checks.get(path)
+                if result is None or result[0] != state:
+                    try:
+                        languages = tree_languages(self.store.tree(path).getroot())
+                    except Exception as e:
+                        result = (state, [f"{path}: can't parse ({e})"], [])
+                    else:
+                        errors = language_errors(
+                            path, languages, expected, self.base_folder
+                        )
+                        result = (state, [], errors)
+                checks[path] = result
+                parse_errors += result[1]
+                target_errors += result[2]
+        self.checks = checks
+        return 0 if print_report(locales, parse_errors, target_errors) else 1
+
+    def status(self):
+        inventory = self.store.inventory
+        trees = sum(
+            1 for tree in self.store.trees.values() if not isinstance(tree, Exception)
+        )
+        print(
+            f"Watching {self.base_folder}: {len(inventory.locales())} folders, "
+            f"{len(self.store.signatures)} files, {trees} trees in memory."
+        )
+        return 0
+
+    def handle(self, request):
+        """
+        Run the command of a client request, and return the response: the
+        output of the command, and its exit status.
+        """
+        command = request.get("command")
+        output = io.StringIO()
+        with redirect_stdout(output):
+            try:
+                self.store.refresh()
+                if command == "update":
+                    status = self.update(
+                        request.get("type", "standard"),
+                        request.get("fill_from_tm", False),
+                    )
+                elif command == "check":
+                    status = self.check()
+                elif command == "status":
+                    status = self.status()
+                elif command == "stop":
+                    print("Daemon stopped.")
+                    status = 0
+                else:
+                    print(f"ERROR: Unknown command {command}")
+                    status = 2
+            except SystemExit as e:
+                # Fatal errors of the scripts only end the command.
+                if isinstance(e.code, str):
+                    print(e.code)
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                print(traceback.format_exc(), end="")
+                status = 1
+        return {"output": output.getvalue(), "status": status}
+
+
+def _receive(connection):
+    chunks = []
+    while True:
+        chunk = connection.recv(65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def send_command(socket_path, request):
+    """
+    Send a request to the daemon listening on 'socket_path', and return its
+    response.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client:
+        try:
+            client.connect(socket_path)
+        except OSError as e:
+            sys.exit(f"ERROR: No daemon listening on {socket_path}\n{e}")
+        client.sendall(json.dumps(request).encode("utf-8"))
+        client.shutdown(socket.SHUT_WR)
+        return json.loads(_receive(client))
+
+
+def serve(daemon, socket_path, interval):
+    """
+    Answer client requests until a 'stop' command, polling the folder for
+    changes while idle.
+    """
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        with probe:
+            if probe.connect_ex(socket_path) == 0:
+                sys.exit(f"ERROR: A daemon is already listening on {socket_path}")
+        # Left behind by a daemon that didn't stop cleanly.
+        os.remove(socket_path)
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+
+    start = time.perf_counter()
+    daemon.store.refresh()
+    daemon.store.load(daemon.store.signatures)
+    print(
+        f"Loaded {len(daemon.store.signatures)} files in "
+        f"{time.perf_counter() - start:.1f} s, listening on {socket_path}",
+        flush=True,
+    )
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    server.settimeout(interval)
+    try:
+        while True:
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                daemon.poll()
+                continue
+            with connection:
+                connection.settimeout(None)
+                try:
+                    request = json.loads(_receive(connection))
+                except ValueError:
+                    continue
+                start = time.perf_counter()
+                response = daemon.handle(request)
+                print(
+                    f"{request.get('command')}: exit status {response['status']} "
+                    f"in {(time.perf_counter() - start) * 1000:.1f} ms",
+                    flush=True,
+                )
+                try:
+                    connection.sendall(json.dumps(response).encode("utf-8"))
+                except OSError:
+                    pass
+            if request.get("command") == "stop":
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        choices=COMMANDS,
+        help="Start the daemon ('serve'), or send it a command",
+    )
+    parser.add_argument(
+        "--path",
+        required=True,
+        dest="base_folder",
+        help="Path to folder including subfolders for all locales",
+    )
+    parser.add_argument(
+        "--socket",
+        dest="socket_path",
+        help=f"Path to the daemon socket (default: {CACHE_FOLDER}/{SOCKET_NAME} "
+        "in the path)",
+    )
+    parser.add_argument(
+        "--reference",
+        default="en",
+        dest="reference_locale",
+        help="Locale code for source strings (default: en, 'serve' only)",
+    )
+    parser.add_argument(
+        "--project",
+        default=None,
+        choices=sorted(PROJECTS),
+        help="Project config to use (locale mapping + excluded folders, "
+        "'serve' only). Defaults to no mapping and no excluded folders.",
+    )
+    parser.add_argument(
+        "--interval",
+        default=1.0,
+        type=float,
+        help="Seconds between two polls of the folder (default: 1, 'serve' only)",
+    )
+    parser.add_argument(
+        "--type",
+        default="standard",
+        choices=UPDATE_TYPES,
+        dest="update_type",
+        help="Type of update (see update_other_locales.py, 'update' only)",
+    )
+    parser.add_argument(
+        "--fill-from-tm",
+        action="store_true",
+        help="Fill untranslated strings from the translation memory of the "
+        "locale ('update' only)",
+    )
+    args = parser.parse_args()
+
+    base_folder = os.path.realpath(args.base_folder)
+    socket_path = args.socket_path or default_socket_path(base_folder)
+    if args.command == "serve":
+        daemon = Daemon(
+            base_folder, args.reference_locale, get_project_config(args.project)
+        )
+        serve(daemon, socket_path, args.interval)
+        return
+
+    request = {"command": args.command}
+    if args.command == "update":
+        request.update(type=args.update_type, fill_from_tm=args.fill_from_tm)
+    response = send_command(socket_path, request)
+    print(response["output"], end="")
+    sys.exit(response["status"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+#! /usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+l10n_pipeline.py --path <folder> [--reference <locale>]
+     [--input <ts> --output <xliff>]... [--input-dir <folder> --output-dir <folder>]
+     [--converter lconvert|builtin] [--lib <path>] [--clean <xliff>]...
+     [--type standard|nofile|matchid] [--project <name>] [--jobs <N>]
+     [--engine tree|stream] [--incremental] [--fill-from-tm]
+
+ Run the whole string extraction in one process, instead of chaining the
+ individual scripts:
+ 1. extract: convert .ts files to XLIFF (extract_source_strings.py).
+ 2. clean: clean up reference files not generated from a .ts file, like the
+    shared addon strings (clean_xliff_targets.py).
+ 3. target-language: set target-language to en-US in all reference files
+    (set_target_language_en.py).
+ 4. write: write the reference files that changed.
+ 5. update: update all other locales (update_other_locales.py).
+ 6. remove obsolete: remove localized files no longer in the reference
+    (remove_obsolete_files.py).
+
+ Reference files are parsed at most once and shared in memory across stages,
+ and each one is written at most once. The time spent in each stage is
+ printed at the end. Options have the same meaning as in the scripts above.
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+from argparse import RawTextHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+
+from clean_xliff_targets import clean_xliff
+from extract_source_strings import extract_tree, map_input_folder
+from functions import Inventory, find_xliff_files, write_xliff
+from locale_config import PROJECTS, get_project_config
+from lxml import etree
+from remove_obsolete_files import remove_extra_files
+from set_target_language_en import set_target_language
+from update_other_locales import UPDATE_TYPES, update_locales
+
+
+@contextmanager
+def timed(timings, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+def _extract_in_worker(task):
+    """
+    Run extract_tree() in a worker, and return the serialized tree (trees
+    can't be pickled) with the captured output.
+    """
+    output = io.StringIO()
+    with redirect_stdout(output):
+        root = extract_tree(*task)
+    return etree.tostring(root, encoding="UTF-8"), output.getvalue()
+
+
+def extract(pairs, converter, lib_path, jobs):
+    """
+    Extract the (input, output) pairs, and return a dict of normalized trees
+    by output path.
+    """
+    tasks = [
+        (input_path, output_file, converter, lib_path)
+        for input_path, output_file in pairs
+    ]
+    trees = {}
+    if jobs == 1 or len(tasks) < 2:
+        for task in tasks:
+            trees[os.path.realpath(task[1])] = extract_tree(*task)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            # map() yields results in task order, keeping the log deterministic.
+            for task, (xml, output) in zip(
+                tasks, executor.map(_extract_in_worker, tasks)
+            ):
+                print(output, end="")
+                trees[os.path.realpath(task[1])] = etree.fromstring(xml)
+    return trees
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+    parser.add_argument(
+        "--path",
+        required=True,
+        dest="base_folder",
+        help="Path to folder containing subfolders for all locales",
+    )
+    parser.add_argument(
+        "--reference",
+        default="en",
+        dest="reference_locale",
+        help="Locale code for source strings (default: en)",
+    )
+    parser.add_argument(
+        "--input",
+        action="append",
+        default=[],
+        dest="input_paths",
+        help="Path to a .ts file to extract (paired in order with --output)",
+    )
+    parser.add_argument(
+        "--output",
+        action="append",
+        default=[],
+        dest="output_files",
+        help="Path to the output XLIFF file for --input",
+    )
+    parser.add_argument(
+        "--input-dir",
+        dest="input_folder",
+        help="Folder of .ts files, each extracted to\n"
+        "<output-dir>/<name>/strings.xliff",
+    )
+    parser.add_argument(
+        "--output-dir",
+        dest="output_folder",
+        help="Output folder for --input-dir",
+    )
+    parser.add_argument(
+        "--converter",
+        choices=["lconvert", "builtin"],
+        default="lconvert",
+        help="How to convert .ts files (default: lconvert)",
+    )
+    parser.add_argument(
+        "--lib",
+        default="",
+        dest="lib_path",
+        help="Path to qt libraries",
+    )
+    parser.add_argument(
+        "--clean",
+        action="append",
+        default=[],
+        dest="clean_files",
+        help="Reference XLIFF file to clean up (can be repeated)",
+    )
+    parser.add_argument(
+        "--type",
+        default="standard",
+        choices=UPDATE_TYPES,
+        dest="update_type",
+        help="Type of update for other locales (see update_other_locales.py)",
+    )
+    parser.add_argument(
+        "--project",
+        default=None,
+        choices=sorted(PROJECTS),
+        help="Project config to use (locale mapping + excluded folders)",
+    )
+    parser.add_argument(
+        "--jobs",
+        default=1,
+        type=int,
+        help="Number of worker processes (default: 1, serial; 0: one per CPU)",
+    )
+    parser.add_argument(
+        "--engine",
+        default="tree",
+        choices=("tree", "stream"),
+        help="How 'standard' mode reads localized files",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only update files whose reference changed since the last\n"
+        "incremental run ('standard' mode)",
+    )
+    parser.add_argument(
+        "--fill-from-tm",
+        action="store_true",
+        help="Fill untranslated strings with the translation of the same\n"
+        "source text in any file of the locale (translation memory)",
+    )
+    args = parser.parse_args()
+
+    if len(args.input_paths) != len(args.output_files):
+        parser.error("--input and --output must be provided in pairs")
+    if bool(args.input_folder) != bool(args.output_folder):
+        parser.error("--input-dir and --output-dir must be used together")
+
+    reference_locale = args.reference_locale
+    base_folder = os.path.realpath(args.base_folder)
+    reference_path = os.path.join(base_folder, reference_locale)
+    config = get_project_config(args.project)
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    timings = {}
+
+    with timed(timings, "extract"):
+        pairs = list(zip(args.input_paths, args.output_files))
+        if args.input_folder:
+            pairs += map_input_folder(args.input_folder, args.output_folder)
+        trees = extract(pairs, args.converter, args.lib_path, jobs)
+
+    with timed(timings, "clean"):
+        for xliff_file in args.clean_files:
+            xliff_path = os.path.realpath(xliff_file)
+            if xliff_path not in trees:
+                trees[xliff_path] = etree.parse(xliff_path).getroot()
+            clean_xliff(trees[xliff_path])
+
+    with timed(timings, "target-language"):
+        for filename in find_xliff_files(reference_path):
+            xliff_path = os.path.realpath(os.path.join(reference_path, filename))
+            if xliff_path not in trees:
+                trees[xliff_path] = etree.parse(xliff_path).getroot()
+        # Reference trees by path relative to the reference folder.
+        reference_trees = {}
+        for xliff_path, root in trees.items():
+            filename = os.path.relpath(xliff_path, reference_path)
+            if not filename.startswith(".."):
+                set_target_language(root)
+                reference_trees[filename] = root.getroottree()
+        reference_files = sorted(reference_trees)
+        if not reference_files:
+            sys.exit(f"No reference file found in {reference_path}")
+
+    with timed(timings, "write"):
+        changed_files = 0
+        for xliff_path, root in trees.items():
+            if write_xliff(root, xliff_path):
+                print(f"Updated {xliff_path}")
+                changed_files += 1
+        print(f"{changed_files} reference files changed.")
+
+    with timed(timings, "update"):
+        # Scanned after the write stage, which may have added reference files.
+        inventory = Inventory(base_folder)
+        locales = inventory.locales(
+            skip={reference_locale, *config["excluded_folders"]}
+        )
+        update_locales(
+            base_folder,
+            reference_locale,
+            reference_files,
+            locales,
+            args.update_type,
+            config["mapping"],
+            jobs=jobs,
+            engine=args.engine,
+            incremental=args.incremental,
+            reference_trees=reference_trees,
+            inventory=inventory,
+            fill_from_tm=args.fill_from_tm,
+            excluded_folders=config["excluded_folders"],
+        )
+
+    with timed(timings, "remove obsolete"):
+        remove_extra_files(
+            base_folder,
+            reference_locale,
+            reference_files,
+            inventory,
+            excluded_folders=config["excluded_folders"],
+        )
+
+    print("Stage timings:")
+    for name, duration in timings.items():
+        print(f"  {name}: {duration * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
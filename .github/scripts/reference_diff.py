@@ -0,0 +1,329 @@
+#! /usr/bin/env python3
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+reference_diff.py --new <folder> (--old <folder|manifest> | --since <git-rev>)
+     [--json <report.json>]
+
+ Compare two versions of the reference XLIFF files (e.g. en/ before and after
+ an extraction), and print a summary of the trans-units that were added,
+ removed, changed (same <file> and ID, new source text) or moved to a
+ different <file> block, possibly in another XLIFF file. --json also saves
+ the full report.
+
+ The old version is a reference folder, the manifest saved by
+ 'update_other_locales.py --incremental', or, with --since, the new folder as
+ of a git revision (e.g. HEAD before committing an extraction).
+
+ Units are compared by digests of their source text, keyed by XLIFF file,
+ <file> 'original' and ID (the same digests as the manifest), in a single
+ pass over both versions.
+
+ The report recommends the cheapest update type for the changes: 'nofile'
+ if strings moved with the same source text (their translations need to be
+ moved), 'standard' otherwise. It also lists the reference files each type
+ needs to process: 'update_other_locales.py --diff <report.json>' only
+ updates those, and picks the recommended type with '--type auto'.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+from functions import find_xliff_files
+from lxml import etree
+from xliff_cache import unit_table
+
+UPDATE_TYPES = ("standard", "nofile", "matchid")
+UNIT_CHANGES = ("added", "removed", "changed", "moved")
+
+
+def source_digest(sources):
+    """Return the digest of the source text(s) of a trans-unit in a <file>."""
+    # A missing source text (None) must not match an empty one.
+    texts = sorted(repr(source) for source in sources)
+    return hashlib.blake2b("\n".join(texts).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def table_digests(table):
+    """
+    Return the {id: {original_file: digest}} digests of a unit table (see
+    xliff_cache.unit_table).
+    """
+    sources = {}
+    for file_original, _, units in table:
+        for tu_id, source, _, _ in units:
+            by_file = sources.setdefault(tu_id, {})
+            by_file.setdefault(str(file_original), {})[source] = None
+    return {
+        tu_id: {
+            file_original: source_digest(file_sources)
+            for file_original, file_sources in by_file.items()
+        }
+        for tu_id, by_file in sources.items()
+    }
+
+
+def folder_digests(folder):
+    """Return the {filename: digests} of the XLIFF files in 'folder'."""
+    files = {}
+    for filename, entry in find_xliff_files(folder).items():
+        try:
+            root = etree.parse(entry.path).getroot()
+        except Exception as e:
+            sys.exit(f"ERROR: Can't parse {entry.path}\n{e}")
+        files[filename] = table_digests(unit_table(root))
+    return files
+
+
+def manifest_digests(manifest_path):
+    """Return the {filename: digests} stored in an incremental manifest."""
+    try:
+        with open(manifest_path) as fp:
+            return json.load(fp)["files"]
+    except (OSError, ValueError, KeyError) as e:
+        sys.exit(f"ERROR: Can't read manifest {manifest_path}\n{e}")
+
+
+def git_digests(folder, rev):
+    """
+    Return the {filename: digests} of the XLIFF files in 'folder' as of the
+    git revision 'rev', read with a single 'git cat-file' process.
+    """
+    try:
+        listing = subprocess.run(
+            ["git", "ls-tree", "-r", "-z", "--name-only", rev, "--", "."],
+            cwd=folder,
+            capture_output=True,
+            check=True,
+        ).stdout
+        filenames = [
+            path.decode()
+            for path in listing.split(b"\0")
+            if path.endswith(b".xliff")
+            and not any(part.startswith(b".") for part in path.split(b"/"))
+        ]
+        objects = subprocess.run(
+            ["git", "cat-file", "--batch"],
+            cwd=folder,
+            input="".join(f"{rev}:./{filename}\n" for filename in filenames).encode(),
+            capture_output=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        sys.exit(f"ERROR: Can't read {folder} at {rev}\n{e}")
+
+    files = {}
+    position = 0
+    for filename in filenames:
+        # Each object is '<oid> blob <size>\n<content>\n'.
+        header_end = objects.index(b"\n", position)
+        size = int(objects[position:header_end].split()[2])
+        content = objects[header_end + 1 : header_end + 1 + size]
+        position = header_end + size + 2
+        try:
+            root = etree.fromstring(content)
+        except Exception as e:
+            sys.exit(f"ERROR: Can't parse {filename} at {rev}\n{e}")
+        files[filename.replace("/", os.sep)] = table_digests(unit_table(root))
+    return files
+
+
+def _locations(files):
+    """Return the {id: {(filename, original): digest}} of all units."""
+    locations = {}
+    # Same order whatever the source of the digests.
+    for filename in sorted(files):
+        for tu_id, by_file in files[filename].items():
+            units = locations.setdefault(tu_id, {})
+            for file_original, digest in by_file.items():
+                units[(filename, file_original)] = digest
+    return locations
+
+
+def _unit(tu_id, location):
+    return {"id": tu_id, "file": location[0], "original": location[1]}
+
+
+def diff_references(old, new):
+    """
+    Compare the {filename: digests} of two versions of the reference, and
+    return the report as a JSON-serializable dict (see the top of this file).
+
+    A unit is identified by its ID within a (file, original) location. An ID
+    that disappears from one location and appears in another one is a move
+    (preferably paired with a location that has the same source text).
+    """
+    old_locations = _locations(old)
+    new_locations = _locations(new)
+    units = {change: [] for change in UNIT_CHANGES}
+
+    # New IDs by file and in document order, then IDs only in the old version.
+    for tu_id in {**new_locations, **old_locations}:
+        old_units = old_locations.get(tu_id, {})
+        new_units = new_locations.get(tu_id, {})
+        removed = []
+        for location, digest in old_units.items():
+            if location not in new_units:
+                removed.append(location)
+            elif new_units[location] != digest:
+                units["changed"].append(_unit(tu_id, location))
+        added = [location for location in new_units if location not in old_units]
+
+        # Pair removed and added locations as moves, same source text first.
+        moves = []
+        for location in list(added):
+            for source in removed:
+                if old_units[source] == new_units[location]:
+                    moves.append((source, location))
+                    removed.remove(source)
+                    added.remove(location)
+                    break
+        count = min(len(removed), len(added))
+        moves += zip(removed[:count], added[:count])
+        removed = removed[count:]
+        added = added[count:]
+        for source, location in moves:
+            units["moved"].append(
+                {
+                    "id": tu_id,
+                    "from": {"file": source[0], "original": source[1]},
+                    "to": {"file": location[0], "original": location[1]},
+                    "source_changed": old_units[source] != new_units[location],
+                }
+            )
+        units["removed"] += [_unit(tu_id, location) for location in removed]
+        units["added"] += [_unit(tu_id, location) for location in added]
+
+    # Files 'standard' needs to process: those with stale translations, i.e.
+    # source changes in place, or moves with a source change (the translation
+    # is still at the old location).
+    standard_files = {unit["file"] for unit in units["changed"]}
+    standard_files.update(
+        move["from"]["file"] for move in units["moved"] if move["source_changed"]
+    )
+    # Rebuild modes process every file with a change.
+    rebuild_files = set(standard_files)
+    for change in ("added", "removed"):
+        rebuild_files.update(unit["file"] for unit in units[change])
+    for move in units["moved"]:
+        rebuild_files.update((move["from"]["file"], move["to"]["file"]))
+    # Localized files of removed reference files are only removed.
+    removed_files = set(old) - set(new)
+    standard_files -= removed_files
+    rebuild_files -= removed_files
+
+    if any(not move["source_changed"] for move in units["moved"]):
+        recommended_type = "nofile"
+    elif any(units.values()):
+        recommended_type = "standard"
+    else:
+        recommended_type = None
+
+    return {
+        "files": {
+            "added": sorted(set(new) - set(old)),
+            "removed": sorted(removed_files),
+        },
+        "units": units,
+        "recommended_type": recommended_type,
+        "affected_files": {
+            update_type: sorted(
+                standard_files if update_type == "standard" else rebuild_files
+            )
+            for update_type in UPDATE_TYPES
+        },
+    }
+
+
+def format_report(report):
+    """Return the text summary of a diff_references() report."""
+    units = report["units"]
+    counts = ", ".join(f"{len(units[change])} {change}" for change in UNIT_CHANGES)
+    lines = [f"Reference changes: {counts}."]
+    for change in ("added", "removed"):
+        for filename in report["files"][change]:
+            lines.append(f"File {change}: {filename}")
+
+    # Unit changes grouped by file.
+    by_file = {}
+    for change, symbol in (("added", "+"), ("removed", "-"), ("changed", "~")):
+        for unit in units[change]:
+            by_file.setdefault(unit["file"], []).append(
+                f"  {symbol} {unit['id']} ({unit['original']})"
+            )
+    for move in units["moved"]:
+        source = move["from"]
+        target = move["to"]
+        if source["file"] == target["file"]:
+            destination = target["original"]
+        else:
+            destination = f"{target['file']}: {target['original']}"
+        changed = ", source changed" if move["source_changed"] else ""
+        by_file.setdefault(source["file"], []).append(
+            f"  > {move['id']} ({source['original']} -> {destination}{changed})"
+        )
+    for filename in sorted(by_file):
+        lines.append(filename)
+        lines += by_file[filename]
+
+    recommended_type = report["recommended_type"]
+    if recommended_type is None:
+        lines.append("No update needed.")
+    else:
+        count = len(report["affected_files"][recommended_type])
+        lines.append(
+            f"Recommended update: --type {recommended_type} ({count} files affected)"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--new",
+        required=True,
+        dest="new_folder",
+        help="Path to the current reference folder",
+    )
+    old_group = parser.add_mutually_exclusive_group(required=True)
+    old_group.add_argument(
+        "--old",
+        dest="old_path",
+        help="Path to the previous reference folder, or to a manifest saved "
+        "by update_other_locales.py --incremental",
+    )
+    old_group.add_argument(
+        "--since",
+        help="Compare with the reference folder at this git revision",
+    )
+    parser.add_argument(
+        "--json",
+        dest="json_path",
+        help="Save the full report to this JSON file",
+    )
+    args = parser.parse_args()
+
+    new_folder = os.path.realpath(args.new_folder)
+    if args.since:
+        old = git_digests(new_folder, args.since)
+    elif os.path.isfile(args.old_path):
+        old = manifest_digests(args.old_path)
+    else:
+        old = folder_digests(os.path.realpath(args.old_path))
+    report = diff_references(old, folder_digests(new_folder))
+
+    if args.json_path:
+        with open(args.json_path, "w") as fp:
+            json.dump(report, fp, indent=1)
+            fp.write("\n")
+    print(format_report(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,20 +5,115 @@
 
 """
 remove_obsolete_files.py --reference <locale> --path <base_l10n_folder>
+     [--project <name>] [--dry-run]
 
  Get a list of all XLIFF files in the reference locale. Then remove all
- extra XLIFF files in locale folders.
+ extra XLIFF files in locale folders, and the folders left empty by their
+ removal (e.g. the folder of an addon removed from the reference).
+
+ --project selects the excluded folders from locale_config.py, which are not
+ treated as locales. --dry-run only prints what would be removed.
 """
 
-from glob import glob
+from functions import Inventory
+from locale_config import PROJECTS, get_project_config
 import argparse
 import os
 import sys
 
-
 NS = {"x": "urn:oasis:names:tc:xliff:document:1.2"}
 
 
+def find_extra_files(inventory, reference_locale, reference_files, excluded=()):
+    """
+    Return the paths (relative to the base folder) of the XLIFF files in
+    locale folders that are not in 'reference_files'.
+    """
+    reference_files = set(reference_files)
+    extra_files = []
+    for locale in inventory.locales(skip={reference_locale, *excluded}):
+        extra_files += [
+            os.path.join(locale, filename)
+            for filename in inventory.locale_files(locale)
+            if filename not in reference_files
+        ]
+    return extra_files
+
+
+def find_empty_folders(base_folder, extra_files):
+    """
+    Return the folders (relative to the base folder, deepest first) that
+    would be empty once 'extra_files' are removed. Locale folders are kept.
+    """
+    removed = set(extra_files)
+    candidates = set()
+    for f in extra_files:
+        folder = os.path.dirname(f)
+        # Stop at the locale folder.
+        while os.path.dirname(folder):
+            candidates.add(folder)
+            folder = os.path.dirname(folder)
+
+    empty_folders = []
+    # By locale, deepest first, so that subfolders are checked before their
+    # parent.
+    candidates = sorted(
+        candidates, key=lambda f: (f.split(os.sep, 1)[0], -f.count(os.sep), f)
+    )
+    for folder in candidates:
+        if all(
+            os.path.join(folder, name) in removed
+            for name in os.listdir(os.path.join(base_folder, folder))
+        ):
+            removed.add(folder)
+            empty_folders.append(folder)
+    return empty_folders
+
+
+def remove_extra_files(
+    base_folder,
+    reference_locale,
+    reference_files,
+    inventory=None,
+    excluded_folders=(),
+    dry_run=False,
+):
+    """
+    Remove the XLIFF files in locale folders that are not in
+    'reference_files' (paths relative to the reference folder), and the
+    folders left empty. 'inventory' is an Inventory of 'base_folder', scanned
+    if not provided. With 'dry_run', only print what would be removed.
+
+    Return the lists of removed files and folders.
+    """
+    if inventory is None:
+        inventory = Inventory(base_folder)
+
+    extra_files = find_extra_files(
+        inventory, reference_locale, reference_files, excluded_folders
+    )
+    empty_folders = find_empty_folders(base_folder, extra_files)
+
+    action = "Would remove" if dry_run else "Removing"
+    for f in extra_files:
+        print(f"{action} {f}")
+        if not dry_run:
+            os.remove(os.path.join(base_folder, f))
+    for folder in empty_folders:
+        print(f"{action} folder {folder}")
+        if not dry_run:
+            os.rmdir(os.path.join(base_folder, folder))
+
+    if dry_run:
+        locales = {f.split(os.sep, 1)[0] for f in extra_files}
+        print(
+            f"Dry run: {len(extra_files)} files and {len(empty_folders)} "
+            f"folders would be removed in {len(locales)} locales."
+        )
+
+    return extra_files, empty_folders
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -33,6 +128,19 @@ def main():
         dest="base_folder",
         help="Path to folder including subfolders for all locales",
     )
+    parser.add_argument(
+        "--project",
+        required=False,
+        default=None,
+        choices=sorted(PROJECTS),
+        help="Project config to use (excluded folders). "
+        "Defaults to no excluded folders.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the files and folders to remove without removing them",
+    )
     parser.add_argument("locales", nargs="*", help="Locales to process")
     args = parser.parse_args()
 
@@ -43,43 +151,20 @@ def main():
     reference_path = os.path.join(base_folder, reference_locale)
 
     # Get a list of all the reference XLIFF files
-    reference_files = []
-    for xliff_path in glob(f"{reference_path}/**/*.xliff", recursive=True):
-        reference_files.append(os.path.relpath(xliff_path, reference_path))
+    inventory = Inventory(base_folder)
+    reference_files = list(inventory.locale_files(reference_locale))
     if not reference_files:
-        sys.exit(
-            f"No reference file found in {os.path.join(base_folder, reference_locale)}"
-        )
-
-    # Get the list of locales
-    locales = [
-        d
-        for d in os.listdir(base_folder)
-        if os.path.isdir(os.path.join(base_folder, d)) and not d.startswith(".")
-    ]
-    locales.remove(reference_locale)
-    locales.sort()
-
-    # Get the list of obsolete XLIFF files
-    extra_files = []
-    for locale in locales:
-        # Get the list of XLIFF files in locale
-        locale_files = []
-        locale_path = os.path.join(base_folder, locale)
-        for xliff_path in glob(f"{locale_path}/**/*.xliff", recursive=True):
-            locale_files.append(os.path.relpath(xliff_path, locale_path))
-
-        extra_files_locale = [
-            f"{locale}/{filename}"
-            for filename in locale_files
-            if filename not in reference_files
-        ]
-        extra_files += extra_files_locale
-
-    # Remove files
-    for f in extra_files:
-        print(f"Removing {f}")
-        os.remove(os.path.join(base_folder, f))
+        sys.exit(f"No reference file found in {reference_path}")
+
+    config = get_project_config(args.project)
+    remove_extra_files(
+        base_folder,
+        reference_locale,
+        reference_files,
+        inventory,
+        excluded_folders=config["excluded_folders"],
+        dry_run=args.dry_run,
+    )
 
 
 if __name__ == "__main__":
@@ -3,30 +3,187 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from functions import write_xliff
-from glob import glob
+"""
+set_target_language_en.py <en_folder> [--jobs <N>]
+set_target_language_en.py --path <folder> [--reference <locale>]
+     [--project <name>] [--jobs <N>] [locales...]
+
+ Set the 'target-language' of every <file> node: to en-US in the XLIFF files
+ of <en_folder>, or, with --path, to the code of each locale in its folder
+ (all locales except the reference, or only the listed ones). The code is
+ mapped with the project config of locale_config.py, like
+ check_target_language.py does, so this fixes the errors that check reports.
+
+ Files whose <file> start tags already declare the expected code are found
+ with a scan of the raw file and left untouched, without being parsed. The
+ others are fixed by 'jobs' worker processes (0 means one per CPU).
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functions import Inventory, find_xliff_files, write_xliff
+from locale_config import PROJECTS, get_locale_code, get_project_config
 from lxml import etree
 import argparse
+import os
+import re
+import sys
+
+NS = {"x": "urn:oasis:names:tc:xliff:document:1.2"}
+
+# Start tag of a <file> element, with any namespace prefix. Quoted attribute
+# values may contain '>'.
+FILE_START_TAG_RE = re.compile(
+    rb"<(?:[\w.-]+:)?file\b((?:[^>\"']|\"[^\"]*\"|'[^']*')*)>"
+)
+TARGET_LANGUAGE_RE = re.compile(rb"\starget-language\s*=\s*(?:\"([^\"]*)\"|'([^']*)')")
+
+
+def set_target_language(root, language="en-US"):
+    """Set the target-language of all <file> elements in the tree."""
+    for file_node in root.xpath("//x:file", namespaces=NS):
+        file_node.set("target-language", language)
+
+
+def has_target_language(xliff_path, language):
+    """
+    Return True if all the <file> start tags of 'xliff_path' declare
+    'language' as target-language, scanning the raw content.
+
+    The scan is conservative: matches in comments or CDATA sections, escaped
+    values or a file without <file> elements make it return False, and the
+    file is then parsed to be fixed (and left untouched if it was correct).
+    """
+    with open(xliff_path, "rb") as fp:
+        content = fp.read()
+    expected = language.encode()
+    found = False
+    for match in FILE_START_TAG_RE.finditer(content):
+        attribute = TARGET_LANGUAGE_RE.search(match.group(1))
+        if attribute is None or (attribute.group(1) or attribute.group(2)) != expected:
+            return False
+        found = True
+    return found
+
+
+def fix_file(task):
+    """
+    Set the target-language of a (xliff_path, language) task, and return
+    (changed, error): whether the file was written, and an error message if
+    it couldn't be parsed.
+    """
+    xliff_path, language = task
+    try:
+        root = etree.parse(xliff_path).getroot()
+    except Exception as e:
+        return False, f"ERROR: Can't parse {xliff_path}\n{e}"
+    set_target_language(root, language)
+    return write_xliff(root, xliff_path), None
+
+
+def fix_target_languages(tasks, jobs=1):
+    """
+    Set the target-language of the (xliff_path, language) 'tasks', leaving
+    correct files untouched, and return (changed_files, errors).
+    """
+    tasks = [task for task in tasks if not has_target_language(*task)]
+
+    jobs = jobs if jobs > 0 else os.cpu_count()
+    if jobs == 1 or len(tasks) < 2:
+        results = [fix_file(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            # map() yields results in task order, keeping the log deterministic.
+            results = list(executor.map(fix_file, tasks, chunksize=8))
+
+    changed_files = []
+    errors = []
+    for (xliff_path, _), (changed, error) in zip(tasks, results):
+        if error:
+            errors.append(error)
+        elif changed:
+            print(f"Updated {xliff_path}")
+            changed_files.append(xliff_path)
+    return changed_files, errors
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "en_path",
+        nargs="?",
         help="Path to the folder to check",
     )
+    parser.add_argument(
+        "--path",
+        dest="base_folder",
+        help="Path to folder including subfolders for all locales, to set "
+        "the target-language of each locale instead of en-US",
+    )
+    parser.add_argument(
+        "--reference",
+        default="en",
+        dest="reference_locale",
+        help="Reference locale code to skip with --path (default: en)",
+    )
+    parser.add_argument(
+        "--project",
+        default=None,
+        choices=sorted(PROJECTS),
+        help="Project config to use with --path (locale mapping + excluded "
+        "folders). Defaults to no mapping and no excluded folders.",
+    )
+    parser.add_argument(
+        "--jobs",
+        default=1,
+        type=int,
+        help="Number of worker processes (default: 1, serial; 0: one per CPU)",
+    )
+    parser.add_argument(
+        "locales",
+        nargs="*",
+        help="Locales to fix with --path; if none are listed, all locale "
+        "subfolders in the path will be fixed",
+    )
     args = parser.parse_args()
 
-    NS = {"x": "urn:oasis:names:tc:xliff:document:1.2"}
-    for xliff_path in glob(f"{args.en_path}/**/*.xliff", recursive=True):
-        tree = etree.parse(xliff_path)
-        root = tree.getroot()
+    if args.base_folder:
+        if args.en_path:
+            # The first locale was parsed as the en folder.
+            args.locales.insert(0, args.en_path)
+        config = get_project_config(args.project)
+        inventory = Inventory(
+            os.path.realpath(args.base_folder), excluded=config["excluded_folders"]
+        )
+        locales = args.locales or inventory.locales(skip={args.reference_locale})
+        tasks = [
+            (
+                inventory.path(locale, filename),
+                get_locale_code(config["mapping"], locale),
+            )
+            for locale in locales
+            for filename in inventory.locale_files(locale)
+        ]
+    elif args.en_path:
+        tasks = [
+            (os.path.join(args.en_path, filename), "en-US")
+            for filename in find_xliff_files(args.en_path)
+        ]
+    else:
+        parser.error("either the en folder or --path is required")
 
-        # Set target language to en-US
-        for file_node in root.xpath("//x:file", namespaces=NS):
-            file_node.set("target-language", "en-US")
+    changed_files, errors = fix_target_languages(tasks, args.jobs)
+    for error in errors:
+        print(error)
 
-        write_xliff(root, xliff_path)
+    if args.base_folder:
+        print(
+            f"target-language set in {len(locales)} locales, "
+            f"{len(changed_files)} files changed."
+        )
+    else:
+        print(f"target-language set to en-US, {len(changed_files)} files changed.")
+    if errors:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
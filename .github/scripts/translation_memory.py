@@ -0,0 +1,111 @@
+#! /usr/bin/env python3
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Translation memory of a locale: the existing translations of all its XLIFF
+files, indexed by source text, to reuse them for identical strings in other
+files (e.g. a string moved from mozillavpn.xliff to an addon, or a new addon
+reusing strings of another one).
+
+The memory is built file by file. With a ParseCache (see xliff_cache.py),
+files unchanged since the previous run are read from their cached unit table
+instead of being parsed again. Lookups are a single dict access.
+"""
+
+from instrumentation import profiler
+from lxml import etree
+from xliff_cache import SOURCE_TAG, TARGET_TAG, TRANS_UNIT_TAG
+
+
+class TranslationMemory:
+    """
+    Exact-match translation memory. Each source text maps to the first
+    translation found for it, and to the first translation for each ID, with
+    the file and ID it comes from.
+    """
+
+    __slots__ = ("by_source", "by_source_id")
+
+    def __init__(self):
+        # {source: (target, filename, id)}
+        self.by_source = {}
+        # {(source, id): (target, filename, id)}
+        self.by_source_id = {}
+
+    def add(self, filename, units):
+        """Add the (id, source, target) of the units of a file."""
+        by_source = self.by_source
+        by_source_id = self.by_source_id
+        for tu_id, source, target in units:
+            # Skip missing or empty sources and targets.
+            if not source or not target:
+                continue
+            entry = (target, filename, tu_id)
+            by_source.setdefault(source, entry)
+            by_source_id.setdefault((source, tu_id), entry)
+
+    def add_table(self, filename, table):
+        """Add the units of a file's unit table (see xliff_cache.unit_table)."""
+        self.add(
+            filename,
+            (
+                (tu_id, source, target)
+                for _, _, units in table
+                for tu_id, source, target, _ in units
+            ),
+        )
+
+    def add_tree(self, filename, root):
+        """Add the units of a parsed file."""
+        self.add(filename, _tree_units(root))
+
+    def lookup(self, source, tu_id=None):
+        """
+        Return the (target, filename, id) translation of 'source', preferring
+        one from a unit with the same ID, or None if there's none.
+        """
+        entry = self.by_source_id.get((source, tu_id))
+        if entry is None:
+            entry = self.by_source.get(source)
+        return entry
+
+    def __len__(self):
+        return len(self.by_source)
+
+
+def _tree_units(root):
+    # Cheaper than a unit table: only the first <source> and <target> of
+    # each unit are needed.
+    for trans_node in root.iter(TRANS_UNIT_TAG):
+        source = target = None
+        for child in trans_node:
+            if child.tag == SOURCE_TAG and source is None:
+                source = child.text
+            elif child.tag == TARGET_TAG and target is None:
+                target = child.text
+        yield trans_node.get("id"), source, target
+
+
+def build_translation_memory(inventory, locale, cache=None):
+    """
+    Return the TranslationMemory of the XLIFF files of 'locale' in
+    'inventory' (an Inventory), reading their unit tables through 'cache'
+    (a ParseCache) if provided. Files that can't be parsed are skipped, the
+    update reports them.
+    """
+    translation_memory = TranslationMemory()
+    with profiler.stage("translation memory"):
+        for filename in inventory.locale_files(locale):
+            path = inventory.path(locale, filename)
+            try:
+                if cache is not None:
+                    translation_memory.add_table(filename, cache.load(path))
+                else:
+                    root = etree.parse(path).getroot()
+                    profiler.read(path)
+                    translation_memory.add_tree(filename, root)
+            except Exception:
+                continue
+    return translation_memory
@@ -0,0 +1,249 @@
+#! /usr/bin/env python3
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+In-process replacement for 'lconvert -if ts -of xlf', used by
+extract_source_strings.py with '--converter builtin'.
+
+It builds the same XLIFF 1.2 tree that parsing lconvert's output would
+produce, for the subset of the Qt .ts format generated by lupdate for the VPN
+client: messages grouped in <file> by their first location, in a <group> per
+non-empty context, with developer comments as <note> and Qt-specific details
+(locations, disambiguation comments) as <context-group>. Plural forms, <byte>
+control characters, 'extra-*' fields and old source texts are not supported
+and raise ValueError: use lconvert for those files.
+"""
+
+from lxml import etree
+
+XLIFF_NS = "urn:oasis:names:tc:xliff:document:1.2"
+XML_SPACE_ATTR = "{http://www.w3.org/XML/1998/namespace}space"
+# File name used by lconvert for obsolete messages without a location.
+OBSOLETE_FILE_NAME = "Obsolete_PO_entries"
+# XLIFF datatype by source file extension (anything else is 'plaintext').
+DATATYPES = {
+    "cpp": "cpp",
+    "cxx": "cpp",
+    "c++": "cpp",
+    "hpp": "cpp",
+    "hxx": "cpp",
+    "h++": "cpp",
+    "c": "c",
+    "h": "c",
+    "cc": "c",
+    "ch": "c",
+    "hh": "c",
+    "ui": "x-trolltech-designer-ui",
+}
+
+
+def _text(node):
+    """
+    Return the text of a .ts element. Carriage returns are normalized like
+    an XML parser does when reading lconvert's output back.
+    """
+    if node is None:
+        return ""
+    if len(node):
+        raise ValueError(
+            f"Unsupported <{node[0].tag}> in <{node.tag}> (line {node.sourceline})"
+        )
+    return (node.text or "").replace("\r\n", "\n").replace("\r", "\n")
+
+
+def _datatype(file_name):
+    extension = file_name.rsplit(".", 1)[-1] if "." in file_name else ""
+    return DATATYPES.get(extension, "plaintext")
+
+
+def _language_code(code, default=""):
+    if not code or code == "C":
+        return default
+    return code.replace("_", "-")
+
+
+def read_ts(ts_path):
+    """
+    Parse a .ts file into (source_language, language, messages). Each message
+    is a dict with 'context', 'id', 'source', 'comment', 'extracomment',
+    'translatorcomment', 'translation', 'type' and 'file' (the file name of
+    its first location, or "" if it has none).
+    """
+    root = etree.parse(ts_path).getroot()
+    messages = []
+    # lupdate only writes a location's file name when it differs from the
+    # previous one (see the .ts format).
+    current_file = ""
+    for context in root.iterchildren("context"):
+        context_name = _text(context.find("name"))
+        for message in context.iterchildren("message"):
+            if message.get("numerus") == "yes":
+                raise ValueError(
+                    f"Plural message not supported (line {message.sourceline})"
+                )
+            message_file = current_file
+            first_file = None
+            for child in message:
+                if not isinstance(child.tag, str):
+                    continue
+                if child.tag == "location":
+                    file_name = child.get("filename")
+                    if file_name:
+                        if first_file is None:
+                            current_file = file_name
+                        message_file = file_name
+                    if first_file is None:
+                        first_file = message_file
+                elif child.tag.startswith("extra-") or child.tag in (
+                    "oldsource",
+                    "oldcomment",
+                ):
+                    raise ValueError(
+                        f"<{child.tag}> not supported (line {child.sourceline})"
+                    )
+
+            translation = message.find("translation")
+            messages.append(
+                {
+                    "context": context_name,
+                    "id": message.get("id", ""),
+                    "source": _text(message.find("source")),
+                    "comment": _text(message.find("comment")),
+                    "extracomment": _text(message.find("extracomment")),
+                    "translatorcomment": _text(message.find("translatorcomment")),
+                    "translation": _text(translation),
+                    "type": (
+                        translation.get("type", "finished")
+                        if translation is not None
+                        else "unfinished"
+                    ),
+                    "file": first_file or "",
+                }
+            )
+
+    return (
+        _language_code(root.get("sourcelanguage"), "en"),
+        _language_code(root.get("language")),
+        _resolve_duplicates(messages),
+    )
+
+
+def _resolve_duplicates(messages):
+    """
+    Drop duplicated messages like lconvert does when loading a file: a message
+    is a duplicate if an earlier one has the same ID, or the same context,
+    source and comment when either of them has no ID. The first message is
+    kept, taking the translation of the duplicate if it has none.
+    """
+    by_id = {}
+    by_content = {}
+    result = []
+    for message in messages:
+        original = by_id.get(message["id"]) if message["id"] else None
+        if original is None:
+            content = (message["context"], message["source"], message["comment"])
+            candidate = by_content.get(content)
+            if candidate is not None and not (message["id"] and candidate["id"]):
+                original = candidate
+                if message["id"] and not candidate["id"]:
+                    candidate["id"] = message["id"]
+                    by_id[message["id"]] = candidate
+            elif candidate is None:
+                by_content[content] = message
+
+        if original is None:
+            if message["id"]:
+                by_id[message["id"]] = message
+            result.append(message)
+        elif not original["translation"] and message["translation"]:
+            original["translation"] = message["translation"]
+    return result
+
+
+def _sub(parent, name, text=None, **attrib):
+    node = etree.SubElement(parent, f"{{{XLIFF_NS}}}{name}")
+    for key, value in attrib.items():
+        node.set(key, value)
+    if text is not None:
+        node.text = text
+    return node
+
+
+def convert_ts(ts_path):
+    """Convert a .ts file and return the root of the XLIFF tree."""
+    source_language, language, messages = read_ts(ts_path)
+
+    # Group messages by file, then by context, in order of appearance.
+    files = {}
+    for message in messages:
+        file_name = message["file"]
+        if not file_name and message["type"] == "obsolete":
+            file_name = OBSOLETE_FILE_NAME
+        contexts = files.setdefault(file_name, {})
+        contexts.setdefault(message["context"], []).append(message)
+
+    root = etree.Element(f"{{{XLIFF_NS}}}xliff", nsmap={None: XLIFF_NS})
+    root.set("version", "1.2")
+    message_count = 0
+    for file_name, contexts in files.items():
+        first_message = next(iter(contexts.values()))[0]
+        file_node = _sub(
+            root,
+            "file",
+            original=file_name,
+            datatype=_datatype(first_message["file"]),
+        )
+        file_node.set("source-language", source_language)
+        file_node.set("target-language", language)
+        body = _sub(file_node, "body")
+        for context, context_messages in contexts.items():
+            parent = body
+            if context:
+                parent = _sub(
+                    body,
+                    "group",
+                    restype="x-trolltech-linguist-context",
+                    resname=context,
+                )
+            for message in context_messages:
+                message_count += 1
+                parent.append(_trans_unit(message, message_count))
+
+    return root
+
+
+def _trans_unit(message, message_count):
+    trans_unit = etree.Element(f"{{{XLIFF_NS}}}trans-unit")
+    trans_unit.set("id", message["id"] or f"_msg{message_count}")
+    if message["type"] in ("obsolete", "vanished"):
+        trans_unit.set("translate", "no")
+    elif message["type"] == "finished":
+        trans_unit.set("approved", "yes")
+
+    source = _sub(trans_unit, "source", message["source"])
+    source.set(XML_SPACE_ATTR, "preserve")
+    target = _sub(trans_unit, "target", message["translation"])
+    target.set(XML_SPACE_ATTR, "preserve")
+    if message["type"] == "unfinished" and message["translation"]:
+        target.set("state", "needs-review-translation")
+
+    if message["comment"]:
+        context_group = _sub(trans_unit, "context-group")
+        _sub(
+            context_group,
+            "context",
+            message["comment"],
+            **{"context-type": "x-qt-msgctxt"},
+        )
+    if message["extracomment"]:
+        _sub(
+            trans_unit,
+            "note",
+            message["extracomment"],
+            annotates="source",
+        ).set("from", "developer")
+    if message["translatorcomment"]:
+        _sub(trans_unit, "note", message["translatorcomment"]).set("from", "translator")
+    return trans_unit
@@ -6,12 +6,60 @@
 
 """
 update_other_locales.py --reference <locale> --path <folder>
-     [--type standard|nofile|matchid] [--project <name>] [locales...]
+     [--type standard|nofile|matchid|auto] [--diff <report.json>]
+     [--project <name>] [--jobs <N>] [--incremental] [--engine tree|stream]
+     [--cache] [--fill-from-tm] [--profile <report.json>] [--cprofile <file>]
+     [locales...]
 
  --project selects the locale mapping and excluded folders from
  locale_config.py. When no project name is provided, empty defaults are used
  (no remapping, no excluded folders).
 
+ --jobs spreads the localized files across N worker processes (0 means one
+ per CPU). The reference work is done once in the main process and shared
+ with the workers; output and logs are identical to a serial run.
+
+ --incremental compares the reference against a manifest of per-trans-unit
+ source digests saved by the previous incremental run (.reference_manifest.json
+ in the path, next to the reference folder), and refreshes it at the end. In 'standard' mode only
+ localized files whose reference file changed (IDs or source text) are
+ processed, and the run stops early if nothing changed. Rebuild modes can move
+ translations across files, so they still process every file. The manifest is
+ shared by all locales: it's only saved by runs over all of them, and a
+ reference file whose localized files couldn't all be parsed keeps its old
+ digests, so the next run processes it again.
+
+ --engine stream makes 'standard' mode stream each localized file with
+ iterparse instead of loading the whole tree, keeping a single <trans-unit>
+ in memory. In rebuild modes, each reference file is serialized once into a
+ skeleton of file and unit records, and localized files are written from it
+ with their translations, instead of copying the whole reference tree for
+ each locale. The output is byte-identical; files the streaming writer can't
+ handle fall back to the tree-based path.
+
+ --cache builds the 'standard' reference index from the parse cache (see
+ xliff_cache.py) when the reference file didn't change since the last run.
+ Rebuild modes copy the whole reference tree, so they always parse it.
+
+ --diff restricts the update to the reference files affected by the changes
+ in a report of reference_diff.py, and '--type auto' uses the update type it
+ recommends ('nofile' when strings moved, 'standard' otherwise). Like
+ --incremental, this assumes that localized files were in sync with the old
+ version of the reference.
+
+ --fill-from-tm builds a translation memory of each locale from all its files
+ (see translation_memory.py), and fills untranslated strings with the
+ translation of the same source text found in any of them, e.g. for a string
+ moved to an addon or reused by a new addon. Each filled string is logged with
+ the file and ID the translation comes from. In 'standard' mode, only strings
+ matching the reference (same file and source text) are filled. With --cache,
+ the memory is built from the parse cache for unchanged files.
+
+ --profile saves a JSON report of the time, files, bytes, trans-units and peak
+ memory of each stage (parse, index, update, carry-over, write), including the
+ work of --jobs workers. --cprofile saves cProfile statistics of the main
+ process. See instrumentation.py.
+
  How each localized file is updated depends on the '--type' argument. The two
  behaviors exist because they serve different goals.
 
@@ -51,18 +99,47 @@ update_other_locales.py --reference <locale> --path <folder>
 """
 
 import argparse
+import io
+import json
 import os
+import re
 import sys
 from argparse import RawTextHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
 from copy import deepcopy
-from glob import glob
 
-from functions import list_locales, write_xliff
+from functions import (
+    XML_DECLARATION,
+    Inventory,
+    escape_text,
+    indented_text,
+    serialize_node,
+    start_tag,
+    stream_xliff,
+    write_content,
+    write_xliff,
+)
+from instrumentation import (
+    add_profile_arguments,
+    enable_profiling,
+    profiler,
+    start_profiling,
+)
 from locale_config import PROJECTS, get_locale_code, get_project_config
 from lxml import etree
+from reference_diff import source_digest
+from translation_memory import build_translation_memory
+from xliff_cache import CACHE_FOLDER, ParseCache, default_cache_path
 
 NS = {"x": "urn:oasis:names:tc:xliff:document:1.2"}
+FILE_TAG = f"{{{NS['x']}}}file"
+BODY_TAG = f"{{{NS['x']}}}body"
+TRANS_UNIT_TAG = f"{{{NS['x']}}}trans-unit"
+SOURCE_TAG = f"{{{NS['x']}}}source"
+TARGET_TAG = f"{{{NS['x']}}}target"
 UPDATE_TYPES = ("standard", "nofile", "matchid")
+MANIFEST_NAME = ".reference_manifest.json"
 
 
 def translation_key(update_type, original_id, source_string):
@@ -84,9 +161,9 @@ def iter_units_by_filenode(root):
 
     Iterating by <file> lets us read each file's 'original' attribute once.
     """
-    for file_node in root.xpath("//x:file", namespaces=NS):
+    for file_node in root.iter(FILE_TAG):
         original = file_node.get("original")
-        for trans_node in file_node.xpath(".//x:trans-unit", namespaces=NS):
+        for trans_node in file_node.iter(TRANS_UNIT_TAG):
             yield original, trans_node
 
 
@@ -106,74 +183,275 @@ def reorder_attributes(node, preferred_order):
         node.set(key, current[key])
 
 
-def build_reference_index(reference_root, filename):
+def _source_text(trans_node):
+    # Same as in xliff_cache.unit_table(): False if there's no <source>.
+    source = trans_node.find(SOURCE_TAG)
+    return False if source is None else source.text
+
+
+class ReferenceIndex:
     """
-    Index the reference content as {id: {original_file: set(sources)}}.
+    Reference sources by trans-unit ID and <file> 'original', i.e.
+    {id: {original_file: set(sources)}}, stored as flat dicts of tuples:
+    - sources(id, original) returns the sources of an ID in a <file>.
+    - all_sources(id) returns the sources of an ID across files.
+    Both return None for an unknown ID. get(id) returns the
+    {original_file: frozenset(sources)} dict of an ID, built on demand.
+
+    IDs, file names and sources are interned, since the same strings repeat
+    across units and files. Call freeze() once all units are added.
+    """
+
+    __slots__ = ("_sources", "_all_sources", "_files")
+
+    def __init__(self):
+        # {(id, original): sources}, lists until freeze() and tuples after.
+        self._sources = {}
+        # {id: sources across files}
+        self._all_sources = {}
+        # {id: originals}
+        self._files = {}
+
+    def add(self, tu_id, file_original, source):
+        tu_id = _intern(tu_id)
+        file_original = _intern(file_original)
+        key = (tu_id, file_original)
+        sources = self._sources.get(key)
+        if sources is None:
+            self._sources[key] = [_intern(source)]
+            self._files.setdefault(tu_id, []).append(file_original)
+        elif source not in sources:
+            sources.append(_intern(source))
+
+    def freeze(self):
+        for key, sources in self._sources.items():
+            self._sources[key] = tuple(sources)
+        for tu_id, originals in self._files.items():
+            self._files[tu_id] = tuple(originals)
+            if len(originals) == 1:
+                # Most IDs are in a single file: share its sources.
+                self._all_sources[tu_id] = self._sources[(tu_id, originals[0])]
+            else:
+                all_sources = {}
+                for file_original in originals:
+                    all_sources.update(
+                        dict.fromkeys(self._sources[(tu_id, file_original)])
+                    )
+                self._all_sources[tu_id] = tuple(all_sources)
+        return self
+
+    def sources(self, tu_id, file_original):
+        return self._sources.get((tu_id, file_original))
+
+    def all_sources(self, tu_id):
+        return self._all_sources.get(tu_id)
+
+    def get(self, tu_id, default=None):
+        originals = self._files.get(tu_id)
+        if originals is None:
+            return default
+        return {
+            file_original: frozenset(self._sources[(tu_id, file_original)])
+            for file_original in originals
+        }
+
+    def items(self):
+        for tu_id in self._files:
+            yield tu_id, self.get(tu_id)
+
+    def __contains__(self, tu_id):
+        return tu_id in self._files
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __len__(self):
+        return len(self._files)
+
+    def __eq__(self, other):
+        return isinstance(other, ReferenceIndex) and dict(self.items()) == dict(
+            other.items()
+        )
+
+    def __getstate__(self):
+        return self._sources, self._all_sources, self._files
+
+    def __setstate__(self, state):
+        self._sources, self._all_sources, self._files = state
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def build_reference_index(reference_root, filename, table=None):
+    """
+    Index the reference content as a ReferenceIndex, i.e.
+    {id: {original_file: set(sources)}}.
 
     This structure is necessary to differentiate strings with the same ID but
     placed in different <file> blocks (e.g. CFBundleDisplayName in iOS),
     possibly with different source text.
 
-    Using a set() should be unnecessary, since the same ID shouldn't appear
-    more than once in the same <file> block, but it protects against broken
-    extractions.
+    Keeping several sources per ID and file should be unnecessary, since the
+    same ID shouldn't appear more than once in the same <file> block, but it
+    protects against broken extractions.
+
+    If the reference's unit 'table' is provided (see xliff_cache.unit_table),
+    it's used instead of the tree.
     """
-    reference_index = {}
-    for file_original, trans_node in iter_units_by_filenode(reference_root):
-        source = trans_node.find("x:source", namespaces=NS)
-        tu_id = trans_node.get("id")
-        if source is None:
+    if table is None:
+        units = (
+            (file_original, trans_node.get("id"), _source_text(trans_node))
+            for file_original, trans_node in iter_units_by_filenode(reference_root)
+        )
+    else:
+        units = (
+            (file_original, tu_id, source)
+            for file_original, _, file_units in table
+            for tu_id, source, _, _ in file_units
+        )
+
+    reference_index = ReferenceIndex()
+    unit_count = 0
+    for file_original, tu_id, source in units:
+        unit_count += 1
+        if source is False:
             # A reference unit without a source means a broken extraction.
             sys.exit(
                 f"ERROR: Reference trans-unit '{tu_id}' has no source in {filename}"
             )
-        sources_by_id = reference_index.setdefault(tu_id, {})
-        sources_by_id.setdefault(file_original, set()).add(source.text)
-    return reference_index
+        reference_index.add(tu_id, file_original, source)
+    profiler.units(unit_count)
+    return reference_index.freeze()
+
+
+def translation_from_tm(translation_memory, tu_id, source):
+    """
+    Return the translation of 'source' in 'translation_memory' (a
+    TranslationMemory), or None if there's none. Log where it comes from.
+    """
+    match = translation_memory.lookup(source, tu_id)
+    if match is None:
+        return None
+    translation, filename, match_id = match
+    print(f"Filling '{tu_id}' from translation memory ({filename}: '{match_id}')")
+    return translation
+
+
+def fill_unit(translation_memory, reference_index, file_original, trans_node):
+    """
+    'standard' mode for an untranslated <trans-unit>: add a <target> with the
+    translation of its source text in 'translation_memory', if any. Only
+    strings matching the reference (same ID, file and source text) are filled:
+    the others will be updated by Pontoon.
+    """
+    source_node = trans_node.find(SOURCE_TAG)
+    if source_node is None:
+        return
+    tu_id = trans_node.get("id")
+    file_sources = reference_index.sources(tu_id, file_original)
+    if file_sources is None or source_node.text not in file_sources:
+        return
+    translation = translation_from_tm(translation_memory, tu_id, source_node.text)
+    if translation is not None:
+        target = etree.Element(TARGET_TAG)
+        target.text = translation
+        source_node.addnext(target)
+
+
+def update_unit(reference_index, file_original, trans_node, translation_memory=None):
+    """
+    'standard' mode for a single <trans-unit> in the <file> 'file_original':
+    remove its <target> if the translation is stale (see update_in_place).
+    With a 'translation_memory', untranslated strings are filled from it (see
+    fill_unit).
+    """
+    target = trans_node.find("x:target", namespaces=NS)
+    if target is None:
+        if translation_memory is not None:
+            fill_unit(translation_memory, reference_index, file_original, trans_node)
+        return
+
+    tu_id = trans_node.get("id")
+    all_sources = reference_index.all_sources(tu_id)
+    if all_sources is None:
+        # String was completely removed from the reference. Pontoon will
+        # remove it on next sync, so leave it in place here to avoid noise.
+        return
+
+    source_node = trans_node.find("x:source", namespaces=NS)
+    if source_node is None:
+        # Malformed locale unit; log and skip.
+        print(f"WARNING: Skipping trans-unit '{tu_id}' without source")
+        return
+
+    file_sources = reference_index.sources(tu_id, file_original)
+    if file_sources is None:
+        # The ID exists in the reference but only in a different <file>: the
+        # string moved. A pure move (source text unchanged) is left in place
+        # ('nofile'/'matchid' can relocate the translation). If the source
+        # text also changed, the translation is stale, so drop the target.
+        if source_node.text not in all_sources:
+            target.getparent().remove(target)
+        return
+
+    # Same file: remove only when the source text actually changed here.
+    if source_node.text not in file_sources:
+        target.getparent().remove(target)
 
 
-def update_in_place(reference_index, locale_root):
+def update_in_place(reference_index, locale_root, translation_memory=None):
     """
     'standard' mode: remove a localized <target> when the source text changed
     in the reference for the same XLIFF file, or when the string moved to a
     different <file> and its source text changed. Strings removed upstream,
     and pure moves where the source text is unchanged, are left untouched.
+    Untranslated strings are filled from 'translation_memory', if provided.
     """
+    unit_count = 0
     for file_original, trans_node in iter_units_by_filenode(locale_root):
-        target = trans_node.find("x:target", namespaces=NS)
-        if target is None:
-            # Untranslated string, nothing to do.
-            continue
+        update_unit(reference_index, file_original, trans_node, translation_memory)
+        unit_count += 1
+    profiler.units(unit_count)
 
-        tu_id = trans_node.get("id")
-        sources_by_id = reference_index.get(tu_id)
-        if sources_by_id is None:
-            # String was completely removed from the reference. Pontoon will
-            # remove it on next sync, so leave it in place here to avoid noise.
-            continue
 
-        source_node = trans_node.find("x:source", namespaces=NS)
-        if source_node is None:
-            # Malformed locale unit; log and skip.
-            print(f"WARNING: Skipping trans-unit '{tu_id}' without source")
-            continue
+def stream_update_in_place(reference_index, l10n_file, translation_memory=None):
+    """
+    Streaming version of update_in_place() + write_xliff(), reading the
+    localized file once and keeping a single <trans-unit> in memory. Return
+    whether the file changed, or None if the file can't be streamed (see
+    functions.stream_xliff) and the tree-based path is needed.
+    """
+    unit_count = 0
 
-        files_for_id = sources_by_id.get(file_original)
-        if files_for_id is None:
-            # The ID exists in the reference but only in a different <file>: the
-            # string moved. A pure move (source text unchanged) is left in place
-            # ('nofile'/'matchid' can relocate the translation). If the source
-            # text also changed, the translation is stale, so drop the target.
-            all_sources = set()
-            for file_sources in sources_by_id.values():
-                all_sources.update(file_sources)
-            if source_node.text not in all_sources:
-                target.getparent().remove(target)
-            continue
+    def process_unit(trans_node, file_node):
+        nonlocal unit_count
+        unit_count += 1
+        update_unit(
+            reference_index, file_node.get("original"), trans_node, translation_memory
+        )
 
-        # Same file: remove only when the source text actually changed here.
-        if source_node.text not in files_for_id:
-            target.getparent().remove(target)
+    changed = stream_xliff(l10n_file, process_unit)
+    profiler.units(unit_count)
+    return changed
+
+
+def index_file_units(root):
+    """
+    Index the tree's <file> nodes in document order, returning a list of
+    (original, file_node, units) tuples. 'units' lists (id, trans_node) for the
+    <trans-unit> elements in the <file>'s <body>, in document order.
+    """
+    entries = []
+    for file_node in root.iter(FILE_TAG):
+        units = [
+            (trans_node.get("id"), trans_node)
+            for body in file_node.iterchildren(BODY_TAG)
+            for trans_node in body.iterchildren(TRANS_UNIT_TAG)
+        ]
+        entries.append((file_node.get("original"), file_node, units))
+    return entries
 
 
 def carry_over_obsolete(new_root, locale_root, reference_ids, locale_code):
@@ -191,32 +469,39 @@ def carry_over_obsolete(new_root, locale_root, reference_ids, locale_code):
                    for what obsolete strings existed and where).
     - reference_ids: set of every trans-unit ID that still exists in the
                      reference. An ID not in this set = obsolete string.
+
+    The localized tree is indexed in a single pass (see index_file_units),
+    which gives both the obsolete strings and the anchors for each <file>.
     """
 
     new_file_nodes = {
-        fn.get("original"): fn for fn in new_root.xpath("//x:file", namespaces=NS)
+        file_node.get("original"): file_node for file_node in new_root.iter(FILE_TAG)
     }
+
     # Track the last surviving <file> in the rebuilt tree, so a <file> block
     # removed upstream can be reinserted in its original position (right after
     # the previous surviving <file>) instead of being appended at the end,
     # which would create a reordering diff.
     file_anchor = None
-    for loc_file in locale_root.xpath("//x:file", namespaces=NS):
-        file_original = loc_file.get("original")
-        new_dest = new_file_nodes.get(file_original)
-
-        old_loc_trans_units = loc_file.xpath("./x:body/x:trans-unit", namespaces=NS)
+    for file_original, loc_file, old_loc_trans_units in index_file_units(locale_root):
         nothing_obsolete = all(
-            tu.get("id") in reference_ids for tu in old_loc_trans_units
+            tu_id in reference_ids for tu_id, _ in old_loc_trans_units
         )
 
+        new_dest = new_file_nodes.get(file_original)
         if new_dest is not None:
             # This <file> still exists in the reference; it anchors the
             # position of any following removed <file> block.
             file_anchor = new_dest
             if nothing_obsolete:
                 continue
+            # Index the units already placed in the rebuilt block, to anchor
+            # each obsolete unit after its previous sibling. Units inserted
+            # later are obsolete, so they never need to be looked up.
             new_dest_body = new_dest.find("x:body", namespaces=NS)
+            new_dest_index = {}
+            for tu in new_dest_body.iterchildren(TRANS_UNIT_TAG):
+                new_dest_index.setdefault(tu.get("id"), tu)
         else:
             if nothing_obsolete:
                 # The <file> is gone from the reference but all its strings
@@ -237,6 +522,7 @@ def carry_over_obsolete(new_root, locale_root, reference_ids, locale_code):
                 new_root.insert(0, new_dest)
             else:
                 file_anchor.addnext(new_dest)
+            new_dest_index = {}
             new_file_nodes[file_original] = new_dest
             file_anchor = new_dest
 
@@ -244,16 +530,9 @@ def carry_over_obsolete(new_root, locale_root, reference_ids, locale_code):
         # tree, rebuilt from the reference and already containing any
         # surviving translations. If the <file> was completely removed
         # from the reference, new_dest_body is empty.
-        # Index the units already placed in the rebuilt block, to
-        # anchor each obsolete unit after its previous sibling.
-        new_dest_index = {}
-        for tu_candidate in new_dest_body.xpath("./x:trans-unit", namespaces=NS):
-            new_dest_index.setdefault(tu_candidate.get("id"), tu_candidate)
-
         # Walk the localized units in order, reinserting the obsolete ones.
         anchor = None
-        for tu in old_loc_trans_units:
-            tu_id = tu.get("id")
+        for tu_id, tu in old_loc_trans_units:
             if tu_id in reference_ids:
                 # Surviving unit already in the rebuilt block: use as anchor.
                 anchor = new_dest_index.get(tu_id, anchor)
@@ -266,43 +545,64 @@ def carry_over_obsolete(new_root, locale_root, reference_ids, locale_code):
                 anchor = copy
 
 
-def rebuild_from_reference(reference_tree, locale_root, update_type, locale_code):
+def file_attribute_order(locale_root):
     """
-    'nofile'/'matchid' mode: return a new localized tree built from the
-    reference structure, with existing translations injected. Because it's
-    based on the reference, strings that moved to a different <file> block are
-    re-emitted (with their translation) under their new location. Translations
-    for strings removed upstream are carried over (see carry_over_obsolete).
-    That prevents automation from touching localized files, leaving the removal
-    to Pontoon instead, and reducing merge conflicts.
-
-    'locale_root' is the current localized content of an existing file.
+    Return the attribute names of each localized <file>, in order, by
+    'original'. The rebuilt <file> nodes (which otherwise inherit the
+    reference's order) are reordered to match: without this, different
+    automations (this script, extraction, Pontoon) would start fighting over
+    the attribute order, creating unnecessary diffs.
     """
-    # Remember each localized <file>'s attribute order, to restore it on the
-    # rebuilt tree (which otherwise inherits the reference's order).
-    # Without this, different automations (this script, extraction, Pontoon)
-    # would start fighting over the attribute order, creating unnecessary diffs.
-    locale_file_attr_order = {
+    return {
         fn.get("original"): list(fn.attrib.keys())
         for fn in locale_root.xpath("//x:file", namespaces=NS)
     }
 
-    # Collect existing translations, keyed according to the update type. Keep a
-    # per-file map so a shared ID (e.g. iOS default IDs reused across files with
-    # different translations) can't clobber another file's translation, plus a
-    # file-agnostic fallback used only to relocate a translation whose string
-    # moved to a different <file> block.
+
+def collect_translations(locale_root, update_type):
+    """
+    Collect existing translations, keyed according to the update type (see
+    translation_key), and return them as two dicts:
+    - {(original, key): translation}, so a shared ID (e.g. iOS default IDs
+      reused across files with different translations) can't clobber another
+      file's translation.
+    - {key: translation}, a file-agnostic fallback used only to relocate a
+      translation whose string moved to a different <file> block.
+    """
     translations_by_file = {}
     translations_any = {}
     for file_original, trans_node in iter_units_by_filenode(locale_root):
-        target = trans_node.find("x:target", namespaces=NS)
+        target = trans_node.find(TARGET_TAG)
         if target is None:
             continue
-        source_node = trans_node.find("x:source", namespaces=NS)
+        source_node = trans_node.find(SOURCE_TAG)
         source_string = source_node.text if source_node is not None else None
         key = translation_key(update_type, trans_node.get("id"), source_string)
         translations_by_file[(file_original, key)] = target.text
         translations_any.setdefault(key, target.text)
+    return translations_by_file, translations_any
+
+
+def rebuild_from_reference(
+    reference_tree, locale_root, update_type, locale_code, translation_memory=None
+):
+    """
+    'nofile'/'matchid' mode: return a new localized tree built from the
+    reference structure, with existing translations injected. Because it's
+    based on the reference, strings that moved to a different <file> block are
+    re-emitted (with their translation) under their new location. Translations
+    for strings removed upstream are carried over (see carry_over_obsolete).
+    That prevents automation from touching localized files, leaving the removal
+    to Pontoon instead, and reducing merge conflicts.
+
+    'locale_root' is the current localized content of an existing file.
+    Strings without a translation in it are filled from 'translation_memory',
+    if provided.
+    """
+    locale_file_attr_order = file_attribute_order(locale_root)
+    translations_by_file, translations_any = collect_translations(
+        locale_root, update_type
+    )
 
     # Build the new localized tree from the reference structure.
     new_tree = deepcopy(reference_tree)
@@ -312,7 +612,9 @@ def rebuild_from_reference(reference_tree, locale_root, update_type, locale_code
         tu.get("id") for tu in new_root.xpath("//x:trans-unit", namespaces=NS)
     }
 
+    unit_count = 0
     for file_original, trans_node in iter_units_by_filenode(new_root):
+        unit_count += 1
         source_node = trans_node.find("x:source", namespaces=NS)
         if source_node is None:
             # Malformed reference unit (broken extraction): can't match or
@@ -336,6 +638,11 @@ def rebuild_from_reference(reference_tree, locale_root, update_type, locale_code
             has_translation = True
         else:
             has_translation = False
+            if translation_memory is not None:
+                translation = translation_from_tm(
+                    translation_memory, trans_node.get("id"), source_string
+                )
+                has_translation = translation is not None
 
         existing_target = trans_node.find("x:target", namespaces=NS)
         if has_translation:
@@ -356,7 +663,9 @@ def rebuild_from_reference(reference_tree, locale_root, update_type, locale_code
     # Preserve strings removed from the reference (see carry_over_obsolete).
     # This prevents the diff from growing unnecessarily, leaving the removal
     # to Pontoon instead, and reducing merge conflicts.
-    carry_over_obsolete(new_root, locale_root, reference_ids, locale_code)
+    profiler.units(unit_count)
+    with profiler.stage("carry-over"):
+        carry_over_obsolete(new_root, locale_root, reference_ids, locale_code)
 
     # Set the target-language on every <file> node to the locale code, and
     # restore the localized file's attribute order to avoid noise diffs.
@@ -369,6 +678,900 @@ def rebuild_from_reference(reference_tree, locale_root, update_type, locale_code
     return new_tree
 
 
+# Stands for the <target> text in the pre-serialized units of a
+# RebuildSkeleton (private use characters can't come from a real file).
+TARGET_PLACEHOLDER = "target"
+# Characters that are escaped when serializing text.
+TEXT_ESCAPES_RE = re.compile("[&<>\r]")
+
+
+class _SkeletonUnsupported(Exception):
+    pass
+
+
+class _SkeletonNode:
+    """
+    An element of a RebuildSkeleton containing <trans-unit> elements, or where
+    obsolete ones can be inserted. 'children' lists (child, tail) pairs, where
+    'child' is a _SkeletonNode, a _SkeletonUnit, or the serialized bytes of a
+    subtree the rebuild never changes. 'empty' is the serialized element if it
+    has no children.
+    """
+
+    __slots__ = ("start_tag", "end_tag", "empty", "text", "children")
+
+
+class _SkeletonFile(_SkeletonNode):
+    """
+    A <file> element, whose start tag depends on the locale. 'anchors' maps
+    the ID of each <trans-unit> child of 'body' to its position.
+    """
+
+    __slots__ = ("original", "tag", "attrib", "body", "anchors")
+
+
+class _SkeletonUnit:
+    """
+    A <trans-unit> serialized without <target> ('bare'), and before and after
+    the text of its <target> ('prefix', 'suffix'). A unit without <source>
+    ('source' is False) is never changed, so it's only serialized as is.
+    """
+
+    __slots__ = ("id", "source", "bare", "prefix", "suffix")
+
+
+def _end_tag(start):
+    return b"</" + start[1:].split(b">")[0].split()[0] + b">"
+
+
+def _skeleton_node(node, level, node_class=_SkeletonNode):
+    skeleton_node = node_class()
+    skeleton_node.start_tag = start_tag(node, level == 0)
+    skeleton_node.end_tag = _end_tag(skeleton_node.start_tag)
+    skeleton_node.empty = None if len(node) else serialize_node(node, level)
+    skeleton_node.text = node.text
+    skeleton_node.children = []
+    return skeleton_node
+
+
+def _skeleton_unit(trans_node, level):
+    if any(True for _ in trans_node.iterdescendants(TRANS_UNIT_TAG)):
+        raise _SkeletonUnsupported
+    unit = _SkeletonUnit()
+    unit.id = trans_node.get("id")
+    unit.source = _source_text(trans_node)
+    if unit.source is False:
+        unit.bare = serialize_node(trans_node, level)
+        return unit
+
+    # Make the same changes as rebuild_from_reference() on copies of the unit.
+    bare = deepcopy(trans_node)
+    target = bare.find(TARGET_TAG)
+    if target is not None:
+        bare.remove(target)
+    unit.bare = serialize_node(bare, level)
+
+    translated = deepcopy(trans_node)
+    target = translated.find(TARGET_TAG)
+    if target is None:
+        target = etree.Element(TARGET_TAG)
+        translated.find(SOURCE_TAG).addnext(target)
+    elif len(target):
+        # etree.indent() would replace the translation if it's whitespace.
+        raise _SkeletonUnsupported
+    target.text = TARGET_PLACEHOLDER
+    parts = serialize_node(translated, level).split(TARGET_PLACEHOLDER.encode())
+    if len(parts) != 2:
+        raise _SkeletonUnsupported
+    unit.prefix, unit.suffix = parts
+    return unit
+
+
+def _check_copied(node, nsmap):
+    """
+    Check that 'node', copied from a localized file, serializes the same in the
+    rebuilt file: no namespace declarations, and no nested <file> (which
+    rebuild_from_reference() would update too).
+    """
+    for child in node.iter(tag=etree.Element):
+        if child.nsmap != nsmap or (child is not node and child.tag == FILE_TAG):
+            raise _SkeletonUnsupported
+
+
+def _insert_after(runs, anchor, item):
+    """
+    Record 'item' as inserted right after 'anchor', and return the new anchor.
+    'anchor' is the position of a child in the skeleton (None for the start
+    of its parent), or the run (list) of items that were just inserted. Like
+    addnext(), a new run goes before the runs inserted earlier at the same
+    position.
+    """
+    if isinstance(anchor, list):
+        anchor.append(item)
+        return anchor
+    run = [item]
+    runs.setdefault(anchor, []).insert(0, run)
+    return run
+
+
+def _with_runs(children, runs):
+    """Return the (child, tail) pairs of 'children' with the inserted items."""
+    merged = [(item, item.tail) for run in runs.get(None, ()) for item in run]
+    for position, child in enumerate(children):
+        merged.append(child)
+        if position in runs:
+            merged += [(item, item.tail) for run in runs[position] for item in run]
+    return merged
+
+
+class RebuildSkeleton:
+    """
+    A reference file prepared for the 'nofile'/'matchid' rebuild with
+    '--engine stream'. Each <trans-unit> is serialized once, with and without a
+    <target>, and rebuild() joins these pieces with the translations of a
+    locale, instead of copying and serializing the whole reference tree for
+    each localized file. The output is byte-identical to
+    rebuild_from_reference() followed by write_xliff().
+
+    The reference is also kept serialized in 'xml', for the localized files
+    rebuild() doesn't support.
+    """
+
+    __slots__ = ("root", "nsmap", "reference_ids", "unit_count", "xml")
+
+    def __init__(self, reference_tree):
+        """
+        Raise _SkeletonUnsupported if the reference has a DOCTYPE, nodes
+        outside the root element, namespace declarations below it, or <file>
+        elements that are not unique children of the root.
+        """
+        root = reference_tree.getroot()
+        if (
+            reference_tree.docinfo.doctype
+            or root.getprevious() is not None
+            or root.getnext() is not None
+        ):
+            raise _SkeletonUnsupported
+        self.nsmap = root.nsmap
+        if any(node.nsmap != self.nsmap for node in root.iter(tag=etree.Element)):
+            raise _SkeletonUnsupported
+        originals = [file_node.get("original") for file_node in root.iter(FILE_TAG)]
+        if len(set(originals)) != len(originals):
+            raise _SkeletonUnsupported
+
+        unit_ids = [tu.get("id") for tu in root.iter(TRANS_UNIT_TAG)]
+        self.reference_ids = set(unit_ids)
+        self.unit_count = len(unit_ids)
+        self.root = self._build(root, 0, None)
+        self.xml = etree.tostring(root, encoding="UTF-8")
+
+    def _build(self, node, level, skeleton_file, is_body=False):
+        if node.tag == FILE_TAG:
+            if level != 1 or not len(node):
+                raise _SkeletonUnsupported
+            skeleton_file = _skeleton_node(node, level, _SkeletonFile)
+            skeleton_file.original = node.get("original")
+            skeleton_file.tag = node.tag
+            skeleton_file.attrib = dict(node.attrib)
+            skeleton_file.body = None
+            skeleton_file.anchors = {}
+            skeleton_node = skeleton_file
+            body = node.find(BODY_TAG)
+        else:
+            if level == 0 and not len(node):
+                raise _SkeletonUnsupported
+            skeleton_node = _skeleton_node(node, level)
+            body = None
+
+        for child in node:
+            if not isinstance(child.tag, str):
+                # Comment or processing instruction.
+                item = serialize_node(child, level + 1)
+            elif skeleton_file is not None and child.tag == TRANS_UNIT_TAG:
+                item = _skeleton_unit(child, level + 1)
+                if is_body:
+                    skeleton_file.anchors.setdefault(
+                        item.id, len(skeleton_node.children)
+                    )
+            elif child.tag == FILE_TAG or child is body:
+                item = self._build(child, level + 1, skeleton_file, child is body)
+            elif skeleton_file is not None and any(
+                True for _ in child.iter(TRANS_UNIT_TAG)
+            ):
+                item = self._build(child, level + 1, skeleton_file)
+            elif any(True for _ in child.iter(FILE_TAG)):
+                raise _SkeletonUnsupported
+            else:
+                item = serialize_node(child, level + 1)
+            if child is body:
+                skeleton_file.body = item
+            skeleton_node.children.append((item, child.tail))
+        return skeleton_node
+
+    def tree(self):
+        """Return a new copy of the reference tree."""
+        return etree.ElementTree(etree.fromstring(self.xml))
+
+    def _obsolete_runs(self, locale_root):
+        """
+        Find where carry_over_obsolete() would insert the obsolete strings of
+        'locale_root', and return (root_runs, body_runs, recreated):
+        - root_runs: the <file> elements removed from the reference,
+          recreated after a position in the root (see _insert_after).
+        - body_runs: {body: runs} of the obsolete <trans-unit> elements in
+          each <body> of the skeleton.
+        - recreated: {file_node: obsolete units} for recreated <file>
+          elements.
+        """
+        files = {}
+        for position, (child, _) in enumerate(self.root.children):
+            if isinstance(child, _SkeletonFile):
+                files[child.original] = (position, child)
+        entries = index_file_units(locale_root)
+        if len({original for original, _, _ in entries}) != len(entries):
+            raise _SkeletonUnsupported
+
+        root_runs = {}
+        body_runs = {}
+        recreated = {}
+        file_anchor = None
+        for file_original, loc_file, units in entries:
+            obsolete = [tu for tu_id, tu in units if tu_id not in self.reference_ids]
+            if file_original not in files:
+                if obsolete:
+                    if loc_file.find(BODY_TAG) is None:
+                        raise _SkeletonUnsupported
+                    _check_copied(loc_file, self.nsmap)
+                    recreated[loc_file] = obsolete
+                    file_anchor = _insert_after(root_runs, file_anchor, loc_file)
+                continue
+
+            file_anchor, skeleton_file = files[file_original]
+            if not obsolete:
+                continue
+            if skeleton_file.body is None:
+                raise _SkeletonUnsupported
+            runs = body_runs.setdefault(skeleton_file.body, {})
+            anchor = None
+            for tu_id, tu in units:
+                if tu_id in self.reference_ids:
+                    anchor = skeleton_file.anchors.get(tu_id, anchor)
+                else:
+                    _check_copied(tu, self.nsmap)
+                    anchor = _insert_after(runs, anchor, tu)
+        return root_runs, body_runs, recreated
+
+    def rebuild(self, locale_root, update_type, locale_code, translation_memory=None):
+        """
+        Return the content of the localized file rebuilt from the reference
+        (see rebuild_from_reference), or None if 'locale_root' has content
+        the skeleton doesn't support.
+        """
+        try:
+            with profiler.stage("carry-over"):
+                root_runs, body_runs, recreated = self._obsolete_runs(locale_root)
+        except _SkeletonUnsupported:
+            return None
+        profiler.units(self.unit_count)
+        writer = _SkeletonWriter(
+            self.nsmap,
+            update_type,
+            locale_code,
+            file_attribute_order(locale_root),
+            collect_translations(locale_root, update_type),
+            body_runs,
+            recreated,
+            translation_memory,
+        )
+        writer.output.append(XML_DECLARATION)
+        writer.write_node(self.root, 0, None, root_runs)
+        writer.output.append(b"\n")
+        return b"".join(writer.output)
+
+
+class _SkeletonWriter:
+    """Write a localized file from a RebuildSkeleton (see rebuild())."""
+
+    def __init__(
+        self,
+        nsmap,
+        update_type,
+        locale_code,
+        attr_order,
+        translations,
+        body_runs,
+        recreated,
+        translation_memory,
+    ):
+        self.nsmap = nsmap
+        self.update_type = update_type
+        self.locale_code = locale_code
+        self.attr_order = attr_order
+        self.translations_by_file, self.translations_any = translations
+        self.body_runs = body_runs
+        self.recreated = recreated
+        self.translation_memory = translation_memory
+        self.output = []
+
+    def file_start_tag(self, tag, attrib, original):
+        # Same changes as the end of rebuild_from_reference().
+        node = etree.Element(tag, attrib=attrib, nsmap=self.nsmap)
+        node.set("target-language", self.locale_code)
+        preferred = self.attr_order.get(original)
+        if preferred:
+            reorder_attributes(node, preferred)
+        return start_tag(node, False)
+
+    def write_children(self, start, end, text, children, level, original, body):
+        """
+        Write an element with its (child, tail) 'children', indented as
+        etree.indent() would. 'body' is the <body> of a recreated <file>.
+        """
+        output = self.output
+        output.append(start)
+        before = text
+        for child, tail in children:
+            output.append(indented_text(before, level + 1))
+            if isinstance(child, bytes):
+                output.append(child)
+            elif isinstance(child, _SkeletonUnit):
+                self.write_unit(child, original)
+            elif isinstance(child, _SkeletonNode):
+                self.write_node(child, level + 1, original)
+            elif child in self.recreated:
+                self.write_recreated(child, level + 1)
+            elif child is body:
+                self.write_recreated_body(child, level + 1, original)
+            else:
+                # Node copied from the localized file.
+                output.append(serialize_node(child, level + 1))
+            before = tail
+        output.append(indented_text(before, level))
+        output.append(end)
+
+    def write_node(self, node, level, original, runs=None):
+        if isinstance(node, _SkeletonFile):
+            original = node.original
+            start = self.file_start_tag(node.tag, node.attrib, original)
+        else:
+            start = node.start_tag
+        children = node.children
+        if runs is None:
+            runs = self.body_runs.get(node)
+        if runs:
+            children = _with_runs(children, runs)
+        if not children:
+            self.output.append(node.empty)
+            return
+        self.write_children(
+            start, node.end_tag, node.text, children, level, original, None
+        )
+
+    def write_unit(self, unit, original):
+        output = self.output
+        if unit.source is False:
+            print(f"WARNING: Skipping trans-unit '{unit.id}' without source")
+            output.append(unit.bare)
+            return
+        key = translation_key(self.update_type, unit.id, unit.source)
+        if (original, key) in self.translations_by_file:
+            translation = self.translations_by_file[(original, key)]
+        elif key in self.translations_any:
+            translation = self.translations_any[key]
+        else:
+            translation = None
+            if self.translation_memory is not None:
+                translation = translation_from_tm(
+                    self.translation_memory, unit.id, unit.source
+                )
+            if translation is None:
+                output.append(unit.bare)
+                return
+        if translation is None:
+            # Empty <target/>: turn '<target>' into '<target/>' and drop
+            # '</target>'.
+            output.append(unit.prefix[:-1] + b"/>")
+            output.append(unit.suffix[unit.suffix.index(b">") + 1 :])
+        elif TEXT_ESCAPES_RE.search(translation):
+            output.extend((unit.prefix, escape_text(translation), unit.suffix))
+        else:
+            output.extend((unit.prefix, translation.encode(), unit.suffix))
+
+    def write_recreated(self, file_node, level):
+        # A <file> removed from the reference, keeping only the obsolete
+        # <trans-unit> elements of its <body>.
+        original = file_node.get("original")
+        start = self.file_start_tag(file_node.tag, dict(file_node.attrib), original)
+        self.write_children(
+            start,
+            _end_tag(start),
+            file_node.text,
+            [(child, child.tail) for child in file_node],
+            level,
+            original,
+            file_node.find(BODY_TAG),
+        )
+
+    def write_recreated_body(self, body, level, original):
+        # The obsolete units go first, followed by the other children.
+        children = [(tu, tu.tail) for tu in self.recreated[body.getparent()]]
+        children += [(node, node.tail) for node in body if node.tag != TRANS_UNIT_TAG]
+        start = start_tag(body, False)
+        self.write_children(
+            start, _end_tag(start), body.text, children, level, original, None
+        )
+
+
+def build_rebuild_skeleton(reference_tree):
+    """Return a RebuildSkeleton of the reference, or None if not supported."""
+    try:
+        return RebuildSkeleton(reference_tree)
+    except _SkeletonUnsupported:
+        return None
+
+
+def reference_digests(reference_index):
+    """
+    Convert a build_reference_index() result into a JSON-serializable
+    {id: {original_file: digest}} dict, hashing the source text(s) of each
+    trans-unit. Two reference files with the same digests produce the same
+    'standard' update.
+    """
+    digests = {}
+    for tu_id, sources_by_file in reference_index.items():
+        digests[tu_id] = {}
+        for file_original, sources in sources_by_file.items():
+            digests[tu_id][str(file_original)] = source_digest(sources)
+    return digests
+
+
+def load_manifest(manifest_path, reference_locale):
+    """
+    Return the {filename: digests} mapping stored in the manifest, or an empty
+    dict if there is no usable manifest (every reference file is then
+    considered changed).
+    """
+    try:
+        with open(manifest_path) as fp:
+            manifest = json.load(fp)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("reference") != reference_locale:
+        return {}
+    return manifest.get("files", {})
+
+
+def save_manifest(manifest_path, reference_locale, files):
+    with open(manifest_path, "w") as fp:
+        json.dump(
+            {"reference": reference_locale, "files": files},
+            fp,
+            indent=1,
+            sort_keys=True,
+        )
+        fp.write("\n")
+
+
+def apply_diff_report(report_path, update_type, reference_files):
+    """
+    Return the (update_type, reference_files) to process according to a
+    reference_diff.py report: 'auto' is replaced by the recommended type, and
+    the files the reference changes don't affect are skipped. This assumes
+    that localized files were in sync with the old version of the reference.
+    """
+    try:
+        with open(report_path) as fp:
+            report = json.load(fp)
+    except (OSError, ValueError) as e:
+        sys.exit(f"ERROR: Can't read diff report {report_path}\n{e}")
+
+    if update_type == "auto":
+        update_type = report["recommended_type"]
+        if update_type is None:
+            return None, []
+        print(f"Using --type {update_type} recommended by {report_path}")
+    affected_files = set(report["affected_files"][update_type])
+    return update_type, [f for f in reference_files if f in affected_files]
+
+
+def update_locale_file(
+    reference,
+    base_folder,
+    filename,
+    locale,
+    update_type,
+    mapping,
+    engine="tree",
+    translation_memory=None,
+    locale_tree=None,
+):
+    """
+    Update a single, existing localized file against its reference, and
+    return a (processed, changed) tuple: 'processed' is False if the file
+    can't be parsed, 'changed' is True only if the file was rewritten.
+
+    'reference' is the output of build_reference_index() in 'standard' mode,
+    and the parsed reference tree (or its RebuildSkeleton with the 'stream'
+    engine) in the 'nofile'/'matchid' rebuild modes. 'engine' selects how
+    'standard' mode reads the file ('tree' or 'stream'). Untranslated strings
+    are filled from 'translation_memory' (the locale's TranslationMemory), if
+    provided. 'locale_tree' is the already parsed localized file, updated in
+    place instead of parsing the file again (ignored by the 'stream' engine).
+    """
+    l10n_file = os.path.join(base_folder, locale, filename)
+
+    if update_type == "standard" and engine == "stream":
+        # Capture warnings to print them after the "Processing" line, like
+        # the tree-based path does.
+        output = io.StringIO()
+        try:
+            # Parsing and writing happen while streaming the file.
+            with profiler.stage("update"), redirect_stdout(output):
+                profiler.read(l10n_file)
+                changed = stream_update_in_place(
+                    reference, l10n_file, translation_memory
+                )
+                if changed:
+                    profiler.wrote(l10n_file)
+        except Exception as e:
+            print(f"ERROR: Can't parse {l10n_file}")
+            print(e)
+            return False, False
+        if changed is not None:
+            print(f"Processing {l10n_file} in {update_type} mode")
+            print(output.getvalue(), end="")
+            return True, changed
+
+    if locale_tree is None:
+        try:
+            with profiler.stage("parse"):
+                locale_tree = etree.parse(l10n_file)
+                profiler.read(l10n_file)
+        except Exception as e:
+            print(f"ERROR: Can't parse {l10n_file}")
+            print(e)
+            return False, False
+    locale_root = locale_tree.getroot()
+
+    # Content already serialized by a RebuildSkeleton.
+    content = None
+    if update_type == "standard":
+        # In-place update.
+        print(f"Processing {l10n_file} in {update_type} mode")
+        with profiler.stage("update"):
+            update_in_place(reference, locale_root, translation_memory)
+        new_tree = locale_tree
+    else:
+        # Rebuild from reference, moving existing translations.
+        print(f"Updating {l10n_file} in {update_type} mode")
+        # Resolve the folder name to its XLIFF target-language code.
+        locale_code = get_locale_code(mapping, locale)
+        if isinstance(reference, RebuildSkeleton):
+            with profiler.stage("update"):
+                content = reference.rebuild(
+                    locale_root, update_type, locale_code, translation_memory
+                )
+            if content is None:
+                reference = reference.tree()
+        if content is None:
+            with profiler.stage("update"):
+                new_tree = rebuild_from_reference(
+                    reference, locale_root, update_type, locale_code, translation_memory
+                )
+
+    with profiler.stage("write"):
+        if content is not None:
+            changed = write_content(content, l10n_file)
+        else:
+            changed = write_xliff(new_tree, l10n_file)
+        if changed:
+            profiler.wrote(l10n_file)
+    return True, changed
+
+
+def parse_reference(base_folder, reference_locale, filename, reference_trees=None):
+    """
+    Return the parsed reference file, taken from 'reference_trees' (a dict
+    of already parsed trees by file name) if available.
+    """
+    if reference_trees and filename in reference_trees:
+        return reference_trees[filename]
+    try:
+        reference_file_path = os.path.join(base_folder, reference_locale, filename)
+        with profiler.stage("parse"):
+            reference_tree = etree.parse(reference_file_path)
+            profiler.read(reference_file_path)
+        return reference_tree
+    except Exception as e:
+        sys.exit(f"ERROR: Can't parse reference file {filename}\n{e}")
+
+
+def index_reference(
+    base_folder, reference_locale, filename, reference_trees=None, cache=None
+):
+    """
+    Return the index of a reference file (see build_reference_index). If a
+    ParseCache is provided, and the tree isn't in 'reference_trees', the unit
+    table is read from the cache instead of parsing the file.
+    """
+    if cache is None or (reference_trees and filename in reference_trees):
+        reference_tree = parse_reference(
+            base_folder, reference_locale, filename, reference_trees
+        )
+        with profiler.stage("index"):
+            return build_reference_index(reference_tree.getroot(), filename)
+
+    try:
+        with profiler.stage("parse"):
+            table = cache.load(os.path.join(base_folder, reference_locale, filename))
+    except Exception as e:
+        sys.exit(f"ERROR: Can't parse reference file {filename}\n{e}")
+    with profiler.stage("index"):
+        return build_reference_index(None, filename, table)
+
+
+def load_reference(
+    base_folder,
+    reference_locale,
+    filename,
+    update_type,
+    reference_trees=None,
+    cache=None,
+    engine="tree",
+):
+    """
+    Parse a reference file and return what update_locale_file() needs for it:
+    the reference index in 'standard' mode, the reference tree otherwise (or
+    its RebuildSkeleton with the 'stream' engine, if supported).
+    """
+    # 'standard' only needs an index of the reference sources per ID.
+    # Build once here instead of within the locale loop.
+    if update_type == "standard":
+        return index_reference(
+            base_folder, reference_locale, filename, reference_trees, cache
+        )
+    reference_tree = parse_reference(
+        base_folder, reference_locale, filename, reference_trees
+    )
+    if engine == "stream":
+        with profiler.stage("index"):
+            skeleton = build_rebuild_skeleton(reference_tree)
+        return skeleton or reference_tree
+    return reference_tree
+
+
+# Per-process state for --jobs workers, set once by _init_worker().
+_worker_state = {}
+
+
+def _init_worker(
+    references, base_folder, update_type, mapping, engine, memories, profile
+):
+    """
+    Receive the shared reference work in each worker process. Reference trees
+    can't be pickled, so rebuild modes send them serialized (unless they're
+    a RebuildSkeleton) and each worker parses them lazily, once per
+    reference file. 'memories' are the translation memories by locale (empty
+    without --fill-from-tm).
+    """
+    if profile:
+        enable_profiling()
+    _worker_state.update(
+        references=references,
+        base_folder=base_folder,
+        update_type=update_type,
+        mapping=mapping,
+        engine=engine,
+        memories=memories,
+    )
+
+
+def _update_in_worker(task):
+    """
+    Run update_locale_file() for a (filename, locale) task in a worker, and
+    return (processed, changed, output, stats) so the main process can print
+    the log lines in the same order as a serial run, and add the profiler
+    statistics of the task (None if not profiling) to its own.
+    """
+    filename, locale = task
+    references = _worker_state["references"]
+    reference = references[filename]
+    if isinstance(reference, bytes):
+        with profiler.stage("parse"):
+            reference = etree.ElementTree(etree.fromstring(reference))
+        references[filename] = reference
+
+    output = io.StringIO()
+    with redirect_stdout(output):
+        processed, changed = update_locale_file(
+            reference,
+            _worker_state["base_folder"],
+            filename,
+            locale,
+            _worker_state["update_type"],
+            _worker_state["mapping"],
+            _worker_state["engine"],
+            _worker_state["memories"].get(locale),
+        )
+    return processed, changed, output.getvalue(), profiler.take()
+
+
+def update_locales(
+    base_folder,
+    reference_locale,
+    reference_files,
+    locales,
+    update_type,
+    mapping,
+    jobs=1,
+    engine="tree",
+    incremental=False,
+    reference_trees=None,
+    cache=None,
+    inventory=None,
+    fill_from_tm=False,
+    excluded_folders=(),
+):
+    """
+    Update the localized 'reference_files' (paths relative to the reference
+    folder) of all 'locales' in 'base_folder', as described at the top of
+    this file. Reference trees already parsed by the caller can be passed in
+    'reference_trees' (a dict by file name), to avoid parsing them again, and
+    reference indexes built from a ParseCache ('cache') for unchanged files.
+
+    Only existing localized files are updated, as listed by 'inventory' (an
+    Inventory of 'base_folder', scanned if not provided). In rebuild modes a
+    missing file would only be recreated with no translations, so its
+    creation is left to Pontoon.
+
+    With 'fill_from_tm', the translation memory of each locale is built from
+    all its files before any update (through 'cache' too), and untranslated
+    strings are filled with exact matches of their source text.
+
+    With 'incremental', the manifest is only saved if 'locales' includes all
+    the locale folders of 'inventory', except 'excluded_folders'.
+    """
+    if inventory is None:
+        inventory = Inventory(base_folder)
+
+    # References already loaded while checking the manifest, to avoid parsing
+    # them twice.
+    preloaded = {}
+    if incremental:
+        manifest_path = os.path.join(base_folder, MANIFEST_NAME)
+        old_manifest = load_manifest(manifest_path, reference_locale)
+        new_manifest = {}
+        # A run over some locales only can't tell which files the others need.
+        all_locales = inventory.locales(skip={reference_locale, *excluded_folders})
+        complete = set(all_locales) <= set(locales)
+        for filename in reference_files:
+            reference_index = index_reference(
+                base_folder, reference_locale, filename, reference_trees, cache
+            )
+            new_manifest[filename] = reference_digests(reference_index)
+            if update_type == "standard":
+                preloaded[filename] = reference_index
+
+        if update_type == "standard":
+            reference_files = [
+                filename
+                for filename in reference_files
+                if old_manifest.get(filename) != new_manifest[filename]
+            ]
+            if not reference_files:
+                if complete:
+                    save_manifest(manifest_path, reference_locale, new_manifest)
+                print("No reference changes since the last run, nothing to update.")
+                return
+            print(f"{len(reference_files)} reference files changed since the last run.")
+        else:
+            print(f"Incremental update not supported in {update_type} mode.")
+
+    # Built before updating any file, so the result doesn't depend on the
+    # order of the updates (or on --jobs).
+    memories = {}
+    if fill_from_tm:
+        for locale in locales:
+            memories[locale] = build_translation_memory(inventory, locale, cache)
+
+    def get_reference(filename):
+        if filename in preloaded:
+            return preloaded.pop(filename)
+        return load_reference(
+            base_folder,
+            reference_locale,
+            filename,
+            update_type,
+            reference_trees,
+            cache,
+            engine,
+        )
+
+    jobs = jobs if jobs > 0 else os.cpu_count()
+    updated_files = 0
+    changed_files = 0
+    # Reference files with a localized file that couldn't be parsed.
+    failed_files = set()
+    if jobs == 1:
+        for filename in reference_files:
+            reference = get_reference(filename)
+            for locale in locales:
+                if not inventory.has_file(locale, filename):
+                    continue
+                processed, changed = update_locale_file(
+                    reference,
+                    base_folder,
+                    filename,
+                    locale,
+                    update_type,
+                    mapping,
+                    engine,
+                    memories.get(locale),
+                )
+                updated_files += processed
+                changed_files += changed
+                if not processed:
+                    failed_files.add(filename)
+    else:
+        references = {}
+        for filename in reference_files:
+            reference = get_reference(filename)
+            if update_type != "standard" and not isinstance(reference, RebuildSkeleton):
+                reference = etree.tostring(reference, encoding="UTF-8")
+            references[filename] = reference
+
+        tasks = [
+            (filename, locale)
+            for filename in reference_files
+            for locale in locales
+            if inventory.has_file(locale, filename)
+        ]
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_worker,
+            initargs=(
+                references,
+                base_folder,
+                update_type,
+                mapping,
+                engine,
+                memories,
+                profiler.enabled,
+            ),
+        ) as executor:
+            # map() yields results in task order, keeping the log deterministic.
+            for (filename, _), (processed, changed, output, stats) in zip(
+                tasks, executor.map(_update_in_worker, tasks, chunksize=8)
+            ):
+                print(output, end="")
+                profiler.merge(stats)
+                updated_files += processed
+                changed_files += changed
+                if not processed:
+                    failed_files.add(filename)
+
+    if incremental:
+        if complete:
+            # Keep the old digests of files that couldn't be updated in every
+            # locale, so that the next run processes them again.
+            for filename in failed_files:
+                if filename in old_manifest:
+                    new_manifest[filename] = old_manifest[filename]
+                else:
+                    del new_manifest[filename]
+            save_manifest(manifest_path, reference_locale, new_manifest)
+        else:
+            print("Not all locales were processed, the manifest was not updated.")
+
+    if updated_files == 0:
+        # No localized file matched the reference (e.g. a brand-new project that
+        # isn't localized yet). This is not an error: exit cleanly so a first
+        # import doesn't fail CI, leaving the file creation to Pontoon.
+        print("WARNING: No localized files to update.")
+    else:
+        print(f"{updated_files} files processed, {changed_files} changed.")
+
+
 def main():
     parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
     parser.add_argument(
@@ -387,12 +1590,22 @@ def main():
         "--type",
         required=False,
         default="standard",
-        choices=UPDATE_TYPES,
+        choices=(*UPDATE_TYPES, "auto"),
         dest="update_type",
         help="""Type of update:
     - 'standard': in place, remove a translation only if the source changed
     - 'nofile': rebuild from reference, move translations if ID and source text match
-    - 'matchid': rebuild from reference, move translations if ID matches (ignore source text)""",
+    - 'matchid': rebuild from reference, move translations if ID matches (ignore source text)
+    - 'auto': the type recommended by the --diff report""",
+    )
+
+    parser.add_argument(
+        "--diff",
+        required=False,
+        default=None,
+        dest="diff_path",
+        help="Report of reference_diff.py: only update the files affected\n"
+        "by the reference changes",
     )
 
     parser.add_argument(
@@ -404,6 +1617,49 @@ def main():
         "Defaults to no mapping and no excluded folders.",
     )
 
+    parser.add_argument(
+        "--jobs",
+        required=False,
+        default=1,
+        type=int,
+        help="Number of worker processes (default: 1, serial; 0: one per CPU)",
+    )
+
+    parser.add_argument(
+        "--engine",
+        required=False,
+        default="tree",
+        choices=("tree", "stream"),
+        help="How localized files are updated:\n"
+        "    - 'tree': parse the whole file (default)\n"
+        "    - 'stream': stream the file, one trans-unit at a time in memory\n"
+        "      ('standard'), or write it from a skeleton of the reference\n"
+        "      (rebuild modes)",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only process files whose reference changed since the last\n"
+        f"incremental run ('standard' mode), tracked in {MANIFEST_NAME}",
+    )
+
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Read reference files unchanged since the last run from the parse\n"
+        f"cache ('standard' mode), stored in {CACHE_FOLDER}",
+    )
+
+    parser.add_argument(
+        "--fill-from-tm",
+        action="store_true",
+        help="Fill untranslated strings with the translation of the same source\n"
+        "text in any file of the locale (translation memory)",
+    )
+
+    add_profile_arguments(parser)
+
     parser.add_argument(
         "locales",
         nargs="*",
@@ -411,93 +1667,60 @@ def main():
         "in the path will be processed",
     )
     args = parser.parse_args()
+    start_profiling(args, "update_other_locales")
 
     reference_locale = args.reference_locale
     update_type = args.update_type
+    if update_type == "auto" and not args.diff_path:
+        parser.error("--type auto requires a --diff report")
     config = get_project_config(args.project)
     mapping = config["mapping"]
     excluded_folders = config["excluded_folders"]
 
-    # Get a list of files to update (absolute paths)
+    # Scan the locale folders and their XLIFF files once
     base_folder = os.path.realpath(args.base_folder)
-    reference_path = os.path.join(base_folder, reference_locale)
+    inventory = Inventory(base_folder)
 
     # Get a list of all the reference XLIFF files
-    reference_files = []
-    for xliff_path in glob(reference_path + "/**/*.xliff", recursive=True):
-        reference_files.append(os.path.relpath(xliff_path, reference_path))
+    reference_files = list(inventory.locale_files(reference_locale))
     if not reference_files:
         sys.exit(
             f"No reference file found in {os.path.join(base_folder, reference_locale)}"
         )
 
+    if args.diff_path:
+        update_type, reference_files = apply_diff_report(
+            args.diff_path, update_type, reference_files
+        )
+        if not reference_files:
+            print("No reference changes affecting localized files, nothing to update.")
+            return
+        print(f"{len(reference_files)} reference files affected by the changes.")
+
     # Get the list of locales
     if args.locales:
         locales = args.locales
     else:
-        locales = list_locales(
-            base_folder, excluded=excluded_folders, skip={reference_locale}
-        )
-
-    updated_files = 0
-    for filename in reference_files:
-        # Read reference XML file
-        try:
-            reference_file_path = os.path.join(base_folder, reference_locale, filename)
-            reference_tree = etree.parse(reference_file_path)
-            reference_root = reference_tree.getroot()
-        except Exception as e:
-            sys.exit(f"ERROR: Can't parse reference file {filename}\n{e}")
-
-        # 'standard' only needs an index of the reference sources per ID.
-        # Build once here instead of within the locale loop.
-        reference_index = (
-            build_reference_index(reference_root, filename)
-            if update_type == "standard"
-            else None
-        )
-
-        for locale in locales:
-            l10n_file = os.path.join(base_folder, locale, filename)
-
-            # Every mode requires an existing localized file. In rebuild modes a
-            # missing file would only be recreated with no translations, so its
-            # creation is left to Pontoon.
-            if not os.path.isfile(l10n_file):
-                continue
-
-            try:
-                locale_tree = etree.parse(l10n_file)
-                locale_root = locale_tree.getroot()
-            except Exception as e:
-                print(f"ERROR: Can't parse {l10n_file}")
-                print(e)
-                continue
-
-            if update_type == "standard":
-                # In-place update.
-                print(f"Processing {l10n_file} in {update_type} mode")
-                update_in_place(reference_index, locale_root)
-                write_xliff(locale_tree, l10n_file)
-            else:
-                # Rebuild from reference, moving existing translations.
-                print(f"Updating {l10n_file} in {update_type} mode")
-                # Resolve the folder name to its XLIFF target-language code.
-                locale_code = get_locale_code(mapping, locale)
-                new_tree = rebuild_from_reference(
-                    reference_tree, locale_root, update_type, locale_code
-                )
-                write_xliff(new_tree, l10n_file)
-
-            updated_files += 1
-
-    if updated_files == 0:
-        # No localized file matched the reference (e.g. a brand-new project that
-        # isn't localized yet). This is not an error: exit cleanly so a first
-        # import doesn't fail CI, leaving the file creation to Pontoon.
-        print("WARNING: No localized files to update.")
-    else:
-        print(f"{updated_files} files processed.")
+        locales = inventory.locales(skip={reference_locale, *excluded_folders})
+
+    cache = ParseCache(default_cache_path(base_folder)) if args.cache else None
+    update_locales(
+        base_folder,
+        reference_locale,
+        reference_files,
+        locales,
+        update_type,
+        mapping,
+        jobs=args.jobs,
+        engine=args.engine,
+        incremental=args.incremental,
+        cache=cache,
+        inventory=inventory,
+        fill_from_tm=args.fill_from_tm,
+        excluded_folders=excluded_folders,
+    )
+    if cache is not None:
+        cache.close()
 
 
 if __name__ == "__main__":
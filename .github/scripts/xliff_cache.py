@@ -0,0 +1,142 @@
+#! /usr/bin/env python3
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+On-disk cache of the content extracted from XLIFF files, shared across runs.
+
+Each entry stores the unit table of a file (see unit_table()), keyed by the
+file path and validated against a digest of its content: a changed file is
+parsed again and its entry replaced. Entries are kept in a SQLite database
+(.cache/xliff_units.sqlite in the localization folder by default), and the
+least recently used ones are evicted when the stored tables exceed the size
+limit.
+"""
+
+import hashlib
+import marshal
+import os
+import sqlite3
+import time
+
+from lxml import etree
+
+XLIFF_NS = "urn:oasis:names:tc:xliff:document:1.2"
+FILE_TAG = f"{{{XLIFF_NS}}}file"
+TRANS_UNIT_TAG = f"{{{XLIFF_NS}}}trans-unit"
+SOURCE_TAG = f"{{{XLIFF_NS}}}source"
+TARGET_TAG = f"{{{XLIFF_NS}}}target"
+
+CACHE_FOLDER = ".cache"
+CACHE_NAME = "xliff_units.sqlite"
+# Bump when the unit table format changes, to discard older entries.
+CACHE_VERSION = 1
+# Maximum size of the stored tables, in bytes.
+MAX_CACHE_SIZE = 64 * 1024 * 1024
+# Only refresh the last use of an entry once in a while, to avoid a write for
+# every cache hit.
+TOUCH_INTERVAL = 3600
+
+
+def _node_text(node):
+    # False for a missing node, to tell it apart from an empty one (None).
+    return False if node is None else node.text
+
+
+def unit_table(root):
+    """
+    Return the content of an XLIFF tree as a list of (original, file_attrs,
+    units), one per <file> in document order. 'units' lists the
+    (id, source, target, attrs) of each <trans-unit> in the <file>; 'source'
+    and 'target' are the element text, or False if missing.
+    """
+    table = []
+    for file_node in root.iter(FILE_TAG):
+        units = [
+            (
+                trans_node.get("id"),
+                _node_text(trans_node.find(SOURCE_TAG)),
+                _node_text(trans_node.find(TARGET_TAG)),
+                dict(trans_node.attrib),
+            )
+            for trans_node in file_node.iter(TRANS_UNIT_TAG)
+        ]
+        table.append((file_node.get("original"), dict(file_node.attrib), units))
+    return table
+
+
+def default_cache_path(base_folder):
+    return os.path.join(base_folder, CACHE_FOLDER, CACHE_NAME)
+
+
+class ParseCache:
+    """
+    Cache of unit tables by file path. Safe to use from several processes at
+    once: each one opens its own connection, and SQLite serializes the writes.
+    """
+
+    def __init__(self, path, max_size=MAX_CACHE_SIZE):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != CACHE_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS units")
+            self.db.execute(f"PRAGMA user_version={CACHE_VERSION}")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS units (path TEXT PRIMARY KEY, "
+            "digest BLOB NOT NULL, used REAL NOT NULL, size INTEGER NOT NULL, "
+            "data BLOB NOT NULL)"
+        )
+
+    def load(self, xliff_path):
+        """
+        Return the unit table of 'xliff_path', from the cache if the file
+        didn't change. Parse errors are raised as with etree.parse().
+        """
+        xliff_path = os.path.realpath(xliff_path)
+        with open(xliff_path, "rb") as fp:
+            content = fp.read()
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+
+        row = self.db.execute(
+            "SELECT digest, used, data FROM units WHERE path = ?", (xliff_path,)
+        ).fetchone()
+        now = time.time()
+        if row is not None and row[0] == digest:
+            self.hits += 1
+            if now - row[1] > TOUCH_INTERVAL:
+                self.db.execute(
+                    "UPDATE units SET used = ? WHERE path = ?", (now, xliff_path)
+                )
+            return marshal.loads(row[2])
+
+        self.misses += 1
+        # Parse the file (not 'content') so errors mention the file name.
+        table = unit_table(etree.parse(xliff_path).getroot())
+        data = marshal.dumps(table)
+        self.db.execute(
+            "INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?)",
+            (xliff_path, digest, now, len(data), data),
+        )
+        return table
+
+    def close(self):
+        """Evict the least recently used entries if needed, and close."""
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM units").fetchone()
+        excess = total[0] - self.max_size
+        if excess > 0:
+            evicted = []
+            for path, size in self.db.execute(
+                "SELECT path, size FROM units ORDER BY used"
+            ):
+                if excess <= 0:
+                    break
+                evicted.append((path,))
+                excess -= size
+            self.db.executemany("DELETE FROM units WHERE path = ?", evicted)
+        self.db.close()